@@ -0,0 +1,49 @@
+# Flask app factory shared by all ZooPredict entry points
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# The web app and the command-line tools (initdb, train, the harvesters) all
+# create their Flask app and database engine here so that they share the same
+# configuration, connection pool settings and SQLite tuning.
+
+import logging
+import sqlite3
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+import models
+
+logger = logging.getLogger(__name__)
+
+_sqlite_pragmas = {}
+
+
+def create_app(import_name, config_object="config"):
+    """
+    Creates a Flask app configured from the given configuration object and
+    initializes the database extension for it.
+    :param import_name: the import name of the app, usually __name__ of the caller
+    :param config_object: the configuration object or its import path
+    :return: the Flask app
+    """
+    app = Flask(import_name)
+    app.config.from_object(config_object)
+    models.db.init_app(app)
+
+    _sqlite_pragmas.clear()
+    _sqlite_pragmas.update(app.config.get('SQLITE_PRAGMAS') or {})
+
+    return app
+
+
+@event.listens_for(Pool, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not _sqlite_pragmas:
+        return
+
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sorted(_sqlite_pragmas.items()):
+        cursor.execute("PRAGMA {p} = {v}".format(p=pragma, v=value))
+    cursor.close()
+    logger.debug("Applied SQLite pragmas: {p}".format(p=_sqlite_pragmas))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Walk-forward backtesting of prediction models for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Replays the historical data in time order: for each evaluation period
+# (a month or a year), every candidate model is trained on the data before
+# the period, either on all of it (expanding window) or on a fixed number of
+# days just before it (sliding window), and evaluated on the period itself.
+# This mirrors how the models are actually used, unlike cross-validation on
+# random folds. The feature matrix is built once and the (candidate, period)
+# fits run in parallel.
+
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import logging.config
+
+import numpy as np
+import pandas as pd
+from sklearn import linear_model
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.metrics import accuracy_score, mean_absolute_error, mean_squared_error, median_absolute_error
+from sklearn.svm import SVC
+
+import appfactory
+import config
+import metrics
+import train
+
+logger = logging.getLogger(__name__)
+
+CLASSIFICATION = 'classification'
+REGRESSION = 'regression'
+
+# a candidate model: a name, the task it solves and an unfitted estimator
+Candidate = collections.namedtuple('Candidate', ['name', 'task', 'estimator'])
+
+DEFAULT_CANDIDATES = [
+    Candidate('SVC', CLASSIFICATION, SVC(C=1, kernel='linear')),
+    Candidate('LogisticRegression', CLASSIFICATION, linear_model.LogisticRegression()),
+    Candidate('RandomForestClassifier', CLASSIFICATION, RandomForestClassifier(n_estimators=50, random_state=0)),
+    Candidate('LinearRegression', REGRESSION, linear_model.LinearRegression()),
+    Candidate('Ridge', REGRESSION, linear_model.Ridge()),
+    Candidate('RandomForestRegressor', REGRESSION, RandomForestRegressor(n_estimators=50, random_state=0)),
+]
+
+PERIOD_UNITS = {'month': 'datetime64[M]', 'year': 'datetime64[Y]'}
+
+
+class Backtester(object):
+    """
+    Walk-forward evaluation of candidate models over one precomputed feature matrix.
+    """
+
+    def __init__(self, dates, X, targets, period='month', window_days=None, min_train_size=30):
+        """
+        :param dates: array of the dates of the rows
+        :param X: the feature matrix, one row per date
+        :param targets: dict of target arrays by task (CLASSIFICATION, REGRESSION)
+        :param period: length of the evaluation periods, 'month' or 'year'
+        :param window_days: train on this many days before each period (sliding
+                            window), or on all earlier data if None (expanding window)
+        :param min_train_size: periods with fewer training rows before them are skipped
+        """
+        order = np.argsort(dates, kind='mergesort')
+        self.dates = np.asarray(dates, dtype='datetime64[D]')[order]
+        self.X = np.asarray(X, dtype=np.float64)[order]
+        self.targets = {task: np.asarray(y)[order] for task, y in targets.items()}
+        self.period = period
+        self.window_days = window_days
+        self.min_train_size = min_train_size
+
+    @classmethod
+    def from_model_builder(cls, builder, predictors=train.DEFAULT_PREDICTORS, **kwargs):
+        return cls(builder.dates, builder.data[predictors].values,
+                   {CLASSIFICATION: builder.data[train.DEFAULT_CLASSIFICATION_TARGET].values,
+                    REGRESSION: builder.data[train.DEFAULT_REGRESSION_TARGET].values},
+                   **kwargs)
+
+    def splits(self):
+        """
+        Returns the walk-forward splits in time order.
+        :return: list of (period label, training row slice, test row slice) tuples
+        """
+        periods = self.dates.astype(PERIOD_UNITS[self.period])
+        result = []
+        for period in np.unique(periods):
+            # rows are sorted by date, so both sets are contiguous slices
+            test_start = np.searchsorted(periods, period, side='left')
+            test_end = np.searchsorted(periods, period, side='right')
+            if self.window_days is None:
+                train_start = 0
+            else:
+                window_start = self.dates[test_start] - np.timedelta64(self.window_days, 'D')
+                train_start = np.searchsorted(self.dates, window_start, side='left')
+            if test_start - train_start < self.min_train_size:
+                continue
+            result.append((str(period), slice(train_start, test_start), slice(test_start, test_end)))
+        return result
+
+    def run(self, candidates=DEFAULT_CANDIDATES, n_jobs=-1):
+        """
+        Evaluates all candidates on all splits.
+        :return: a data frame of per-period metrics, one row per candidate and period
+        """
+        jobs = [(candidate, split) for candidate in candidates for split in self.splits()]
+        logger.info("Running {n} backtest fits".format(n=len(jobs)))
+
+        with metrics.histogram("backtest_seconds", "Duration of backtest runs").time():
+            rows = Parallel(n_jobs=n_jobs)(
+                delayed(_evaluate)(candidate, self.X, self.targets[candidate.task], period, train_rows, test_rows)
+                for candidate, (period, train_rows, test_rows) in jobs)
+
+        return pd.DataFrame(rows, columns=['model', 'task', 'period', 'train_size', 'test_size',
+                                           'accuracy', 'mean_absolute_error', 'root_mean_squared_error',
+                                           'median_absolute_error'])
+
+
+def _evaluate(candidate, X, y, period, train_rows, test_rows):
+    model = clone(candidate.estimator)
+    model.fit(X[train_rows], y[train_rows])
+    predicted = model.predict(X[test_rows])
+    actual = y[test_rows]
+
+    row = {'model': candidate.name, 'task': candidate.task, 'period': period,
+           'train_size': train_rows.stop - train_rows.start, 'test_size': len(actual),
+           'accuracy': np.nan, 'mean_absolute_error': np.nan, 'root_mean_squared_error': np.nan,
+           'median_absolute_error': np.nan}
+    if candidate.task == CLASSIFICATION:
+        row['accuracy'] = accuracy_score(actual, predicted)
+    else:
+        row['mean_absolute_error'] = mean_absolute_error(actual, predicted)
+        row['root_mean_squared_error'] = np.sqrt(mean_squared_error(actual, predicted))
+        row['median_absolute_error'] = median_absolute_error(actual, predicted)
+    return row
+
+
+def _weighted_average(values, weights):
+    """
+    Returns the weighted average of the values that are not NaN, or NaN if there are none.
+    """
+    known = ~np.isnan(values)
+    if not known.any():
+        return np.nan
+    return np.average(values[known], weights=weights[known])
+
+
+def summarize(results):
+    """
+    Summarizes per-period results into one row per model, weighting each period by its size.
+    Metrics that do not apply to a model's task are NaN.
+    """
+    def weighted(group):
+        weights = group['test_size'].values
+        return pd.Series(collections.OrderedDict([
+            ('periods', len(group)),
+            ('days', weights.sum()),
+            ('accuracy', _weighted_average(group['accuracy'].values, weights)),
+            ('mean_absolute_error', _weighted_average(group['mean_absolute_error'].values, weights)),
+            ('root_mean_squared_error',
+             np.sqrt(_weighted_average(group['root_mean_squared_error'].values ** 2, weights))),
+            ('median_absolute_error', _weighted_average(group['median_absolute_error'].values, weights)),
+        ]))
+    return results.groupby(['task', 'model']).apply(weighted)
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    train.add_data_arguments(parser)
+    parser.add_argument('-p', '--period', dest='period', choices=sorted(PERIOD_UNITS), default='month',
+                        help='length of the evaluation periods')
+    parser.add_argument('-W', '--window-days', dest='window_days', type=int, default=None,
+                        help='train on a sliding window of this many days; by default on all earlier data')
+    parser.add_argument('-m', '--min-train-size', dest='min_train_size', type=int, default=30,
+                        help='skip periods with fewer training days before them')
+    parser.add_argument('-j', '--jobs', dest='n_jobs', type=int, default=-1,
+                        help='number of parallel jobs; -1 uses all CPUs')
+    parser.add_argument('-o', '--output-path', dest='output_path', default=None,
+                        help='write the per-period metrics into this CSV file')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    app = appfactory.create_app(__name__)
+
+    weather_data, visitor_data = train.load_data(app, args)
+    builder = train.ModelBuilder(app, weather_data, visitor_data)
+    backtester = Backtester.from_model_builder(builder, period=args.period, window_days=args.window_days,
+                                               min_train_size=args.min_train_size)
+    results = backtester.run(n_jobs=args.n_jobs)
+
+    if args.output_path:
+        results.to_csv(args.output_path, index=False)
+        print("Wrote per-period metrics into {p}".format(p=args.output_path))
+
+    print(summarize(results).to_string())
+
+    metrics.dump_json_if_configured(app.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# In-process caching for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# A small thread-safe cache used for the predictions of the model registry
+# and for the rendered fragments of the web UI. Each cache reports its hits
+# and misses as metrics under its own prefix.
+
+import collections
+import threading
+import time
+
+import metrics
+
+
+class TTLCache(object):
+    """
+    A bounded least-recently-used cache whose entries expire after a time-to-live.
+    """
+
+    def __init__(self, max_size, ttl, metric_prefix):
+        """
+        :param max_size: the maximum number of entries
+        :param ttl: the number of seconds after which an entry expires
+        :param metric_prefix: the prefix of the names of the hit and miss metrics, e.g. 'prediction_cache'
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metric_prefix = metric_prefix
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def get(self, key):
+        """
+        Returns the cached value for the key, or None if there is no valid entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                metrics.counter(self.metric_prefix + "_misses_total", "Cache misses").inc()
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.counter(self.metric_prefix + "_hits_total", "Cache hits").inc()
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,74 @@
+# Harvest checkpoints for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# The harvesters record every date they have stored data for in the
+# harvest_checkpoint table, per data source. On each run they look for dates
+# missing within the backfill window (config.HARVEST_BACKFILL_DAYS) and fetch
+# all of them in one batch, so that a harvester that has failed for a few days
+# catches up on its next successful run.
+
+import datetime
+import logging
+
+import metrics
+import models
+
+logger = logging.getLogger(__name__)
+
+FMI_FORECAST = 'fmi_forecast'
+FMI_OBSERVATION = 'fmi_observation'
+ZOO_STATISTIC = 'zoo_statistic'
+
+
+def date_range(start, end):
+    """
+    Returns the list of dates from start to end, inclusive.
+    """
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def backfill_window(today, days):
+    """
+    Returns the first and the last date of the backfill window: the given
+    number of days up to and including yesterday.
+    """
+    return today - datetime.timedelta(days=days), today - datetime.timedelta(days=1)
+
+
+def missing_dates(source, start, end, model=None):
+    """
+    Returns the dates from start to end (inclusive) that have not been harvested
+    from the given source. Must be called within an app context.
+    :param source: the data source, e.g. FMI_OBSERVATION
+    :param start: the first date to check
+    :param end: the last date to check
+    :param model: a persistence model with a date column; dates that already have
+                  rows in it count as harvested, e.g. rows stored before checkpoints were kept
+    :return: the sorted list of missing dates
+    """
+    session = models.db.session
+    checkpoint = models.HarvestCheckpoint
+
+    harvested = {row[0] for row in session.query(checkpoint.date)
+                                          .filter(checkpoint.source == source, checkpoint.date.between(start, end))}
+    if model is not None:
+        harvested.update(row[0] for row in session.query(model.date).filter(model.date.between(start, end))
+                                                                    .distinct())
+
+    missing = [date for date in date_range(start, end) if date not in harvested]
+    if missing:
+        logger.info("Missing {n} dates of {s} data between {a} and {b}".format(n=len(missing), s=source,
+                                                                                a=start, b=end))
+    return missing
+
+
+def mark_harvested(source, dates):
+    """
+    Adds checkpoints for the given dates to the current session. They are
+    committed together with the harvested rows, so that either both or
+    neither are stored. Must be called within an app context.
+    """
+    now = datetime.datetime.now()
+    for date in dates:
+        models.db.session.add(models.HarvestCheckpoint(source, date, now))
+    metrics.counter("harvest_checkpoints_total", "Dates marked as harvested").inc(len(dates), source=source)
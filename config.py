@@ -8,14 +8,99 @@ import os
 SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite://")
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings for server databases (PostgreSQL in production).
+# They are ignored for in-memory SQLite.
+SQLALCHEMY_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
+SQLALCHEMY_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", 1800))
+SQLALCHEMY_POOL_PRE_PING = True
+# PostgreSQL statement timeout in milliseconds; 0 disables the timeout
+DATABASE_STATEMENT_TIMEOUT_MS = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS", 30000))
+
+# PRAGMA statements applied to every new SQLite connection (local mode)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
+
+# How often (in seconds) long-running processes check the database for newly
+# trained prediction models
+MODEL_REFRESH_INTERVAL = int(os.environ.get("MODEL_REFRESH_INTERVAL", 60))
+
+# Predictions are cached by model version and feature vector. The weather
+# features are rounded to PREDICTION_CACHE_QUANTIZATION_STEP before prediction.
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 4096))
+PREDICTION_CACHE_TTL = int(os.environ.get("PREDICTION_CACHE_TTL", 24 * 60 * 60))
+PREDICTION_CACHE_QUANTIZATION_STEP = 0.1
+
+# When several models are active, they predict in parallel in this many threads
+PREDICTION_WORKERS = int(os.environ.get("PREDICTION_WORKERS", 4))
+
+# Rendered fragments of the index page are cached per locale and data version
+# (see models.bump_data_version). The time-to-live bounds how long a change made
+# without bumping the data version can go unnoticed.
+FRAGMENT_CACHE_SIZE = 64
+FRAGMENT_CACHE_TTL = int(os.environ.get("FRAGMENT_CACHE_TTL", 60 * 60))
+
+# Daily forecasts and predictions older than RETENTION_DAYS are rolled up into
+# monthly aggregates by the retention job (retention.py), which deletes rows in
+# batches of RETENTION_BATCH_SIZE.
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 2 * 365))
+RETENTION_BATCH_SIZE = 1000
+
+# Quantiles of the visitor count predicted along with the point prediction:
+# the low end of the range, the median and the high end of the range
+PREDICTION_QUANTILES = [0.1, 0.5, 0.9]
+
+# Schedules of the jobs run by the in-process scheduler (scheduler.py). A job
+# runs either daily at a local time ("daily_at": "HH:MM") or every "interval"
+# seconds, in both cases delayed by a random 0-"jitter" seconds. Jobs missing
+# from this dict or with "enabled" set to False are not run.
+SCHEDULER_JOBS = {
+    'fmi_harvester': {'daily_at': '05:00', 'jitter': 15 * 60},
+    'zoodatafetcher': {'daily_at': '05:30', 'jitter': 15 * 60},
+    'reconciliation': {'daily_at': '06:00', 'jitter': 5 * 60},
+    'retention': {'daily_at': '04:00', 'jitter': 15 * 60},
+    'train': {'interval': 7 * 24 * 60 * 60, 'jitter': 60 * 60},
+}
+# How often (in seconds) the scheduler checks for due jobs
+SCHEDULER_POLL_INTERVAL = 30
+# A job lock not released within this many seconds (e.g. after a crash) expires
+SCHEDULER_LOCK_TIMEOUT = 2 * 60 * 60
+# Whether the models trained by the scheduled "train" job join the active
+# models in an ensemble; otherwise the active models are deactivated (not deleted)
+SCHEDULER_TRAIN_KEEP_EXISTING = False
+
 DEBUG = True
 FLASK_DEBUG = False
 
+# The weather observations are fetched for this FMI observation station
+FMI_OBSERVATION_LOCATION = "kaisaniemi"
+
+# The harvesters look for dates missing from the last HARVEST_BACKFILL_DAYS
+# days on every run and fetch all of them at once
+HARVEST_BACKFILL_DAYS = int(os.environ.get("HARVEST_BACKFILL_DAYS", 14))
+
 #FMI_WEATHER_LOCATION = "kaisaniemi"
 #FMI_WEATHER_LOCATION = "60.17523 24.94459" # Kaisaniemi
 FMI_WEATHER_LOCATION = "60.16952 24.93545"  # Helsinki
 FMI_API_KEY_PATH = "fmi_api_key.txt"
 
+# If set, batch jobs (harvesters, training) write their collected metrics
+# into this file as JSON when they finish.
+METRICS_JSON_PATH = os.environ.get("METRICS_JSON_PATH", None)
+
+# Profiling reports are written into this directory. Command-line jobs are
+# profiled when run with --profile or with ZOOPREDICT_PROFILE=1 set. Web
+# requests are profiled on request (?profile=1 or an X-ZooPredict-Profile
+# header) only if PROFILE_WEB_REQUESTS is enabled.
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", "profiles")
+PROFILE_WEB_REQUESTS = os.environ.get("PROFILE_WEB_REQUESTS", "").lower() in ("1", "true", "yes")
+
 VISITOR_CLASSES = {
     0: {
         "min": 0,
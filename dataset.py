@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+# Columnar training data store for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Keeps the daily zoo visitor counts and weather observations used for
+# training as binary NumPy column files, partitioned by year:
+#
+#     <store>/<table>/<year>/<column>.npy
+#
+# The column files are memory-mapped on reading and only the partitions that
+# overlap the requested date range are opened, so loading training data needs
+# no text parsing no matter how much history has accumulated. The store can be
+# filled from the CSV files, the original Excel workbooks or the database.
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import itertools
+import logging
+import logging.config
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import appfactory
+import config
+import models
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = "data/store"
+DEFAULT_CHUNK_SIZE = 5000
+
+DATE_COLUMN = 'datetime'
+
+# columns and their types for each table, in addition to the date column
+TABLES = {
+    'visitors': [('visitors', np.int64)],
+    'weather': [('precipitation', np.float64), ('temp_mean', np.float64),
+                ('temp_min', np.float64), ('temp_max', np.float64)],
+}
+
+
+class DatasetStore(object):
+    """
+    A directory of year-partitioned, memory-mappable NumPy column files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _table_path(self, table):
+        if table not in TABLES:
+            raise ValueError("Unknown table: {t}".format(t=table))
+        return os.path.join(self.path, table)
+
+    def partitions(self, table):
+        """
+        Returns the years stored for the given table, in ascending order.
+        """
+        table_path = self._table_path(table)
+        if not os.path.isdir(table_path):
+            return []
+        return sorted(int(name) for name in os.listdir(table_path) if name.isdigit())
+
+    def write(self, table, frame):
+        """
+        Stores the rows of a data frame into the table. Rows for dates that are
+        already stored replace the old ones; other stored rows are kept.
+        :param table: the table name, a key of TABLES
+        :param frame: a data frame with a date column ('datetime') and the table's columns
+        """
+        columns = TABLES[table]
+        dates = _to_dates(frame[DATE_COLUMN])
+        years = dates.astype('datetime64[Y]').astype(int) + 1970
+
+        for year in np.unique(years):
+            in_year = years == year
+            new_data = {DATE_COLUMN: dates[in_year]}
+            for name, dtype in columns:
+                new_data[name] = frame[name].values[in_year].astype(dtype)
+
+            existing = self._read_partition(table, year, mmap=False)
+            if existing is not None:
+                keep = ~np.in1d(existing[DATE_COLUMN], new_data[DATE_COLUMN])
+                new_data = {name: np.concatenate([existing[name][keep], values])
+                            for name, values in new_data.items()}
+
+            order = np.argsort(new_data[DATE_COLUMN], kind='mergesort')
+            self._write_partition(table, year, {name: values[order] for name, values in new_data.items()})
+
+        logger.info("Stored {n} rows into table {t}".format(n=len(dates), t=table))
+
+    def read(self, table, start_date=None, end_date=None):
+        """
+        Reads the rows of a table within an inclusive date range. Partitions
+        outside the range are not opened at all.
+        :param table: the table name, a key of TABLES
+        :param start_date: the first date to include, or None for no lower bound
+        :param end_date: the last date to include, or None for no upper bound
+        :return: a data frame with a date column ('datetime') and the table's columns
+        """
+        start = np.datetime64(start_date, 'D') if start_date is not None else None
+        end = np.datetime64(end_date, 'D') if end_date is not None else None
+
+        parts = {name: [] for name in [DATE_COLUMN] + [c for c, _ in TABLES[table]]}
+        for year in self.partitions(table):
+            if start is not None and year < start.astype('datetime64[Y]').astype(int) + 1970:
+                continue
+            if end is not None and year > end.astype('datetime64[Y]').astype(int) + 1970:
+                continue
+
+            partition = self._read_partition(table, year, mmap=True)
+            # dates are sorted within a partition, so the range is a contiguous slice
+            dates = partition[DATE_COLUMN]
+            first = np.searchsorted(dates, start, side='left') if start is not None else 0
+            last = np.searchsorted(dates, end, side='right') if end is not None else len(dates)
+            for name in parts:
+                parts[name].append(partition[name][first:last])
+
+        data = {name: np.concatenate(values) if values else np.array([], dtype=_dtype(table, name))
+                for name, values in parts.items()}
+        return pd.DataFrame(data, columns=[DATE_COLUMN] + [c for c, _ in TABLES[table]])
+
+    def _partition_path(self, table, year):
+        return os.path.join(self._table_path(table), str(year))
+
+    def _read_partition(self, table, year, mmap):
+        path = self._partition_path(table, year)
+        if not os.path.isdir(path):
+            return None
+        mmap_mode = 'r' if mmap else None
+        return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                for name in [DATE_COLUMN] + [c for c, _ in TABLES[table]]}
+
+    def _write_partition(self, table, year, data):
+        # write into a temporary directory first so that readers never see a
+        # partially written partition
+        path = self._partition_path(table, year)
+        tmp_path = path + ".tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, values in data.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(values))
+
+        if os.path.isdir(path):
+            old_path = path + ".old"
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, path)
+
+
+def _dtype(table, name):
+    if name == DATE_COLUMN:
+        return 'datetime64[D]'
+    return dict(TABLES[table])[name]
+
+
+def _to_dates(values):
+    return pd.to_datetime(values).values.astype('datetime64[D]')
+
+
+def weekdays_for_dates(dates):
+    """
+    Returns the weekday names (config.WEEKDAYS) for an array of dates.
+    """
+    # 1970-01-01, day zero of datetime64, was a Thursday
+    weekday_numbers = (np.asarray(dates, dtype='datetime64[D]').astype(np.int64) + 3) % 7
+    return np.array(config.WEEKDAYS)[weekday_numbers]
+
+
+def load_training_data(store, start_date=None, end_date=None):
+    """
+    Loads visitor and weather data from the store in the form ModelBuilder expects.
+    :return: a tuple (weather data frame, visitor data frame)
+    """
+    weather_data = store.read('weather', start_date, end_date)
+    visitor_data = store.read('visitors', start_date, end_date)
+    visitor_data['weekday'] = weekdays_for_dates(visitor_data[DATE_COLUMN].values)
+    return weather_data, visitor_data
+
+
+def load_training_data_from_database(app, start_date=None, end_date=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Loads the days that have both a weather observation and an actual visitor
+    count from the database in the form ModelBuilder expects.
+
+    The tables are joined by the database and the result is streamed in
+    chunks (with a server-side cursor where the driver supports one) into
+    preallocated arrays, so no ORM objects are built and the whole result
+    never has to be held in memory twice.
+    :return: a tuple (weather data frame, visitor data frame)
+    """
+    weather_columns = [c for c, _ in TABLES['weather']]
+    observation = models.WeatherObservation
+    actual = models.ZooStatisticActual
+
+    with app.app_context():
+        query = models.db.session.query(observation.date,
+                                        *([getattr(observation, c) for c in weather_columns] + [actual.visitors]))\
+                                 .join(actual, actual.date == observation.date)
+        if start_date is not None:
+            query = query.filter(observation.date >= start_date)
+        if end_date is not None:
+            query = query.filter(observation.date <= end_date)
+
+        count = query.count()
+        dates = np.empty(count, dtype='datetime64[D]')
+        values = np.empty((count, len(weather_columns) + 1), dtype=np.float64)
+
+        rows = iter(query.order_by(observation.date)
+                         .execution_options(stream_results=True)
+                         .yield_per(chunk_size))
+        filled = 0
+        while filled < count:
+            chunk = list(itertools.islice(rows, min(chunk_size, count - filled)))
+            if not chunk:
+                break
+            dates[filled:filled + len(chunk)] = [row[0] for row in chunk]
+            values[filled:filled + len(chunk)] = [row[1:] for row in chunk]
+            filled += len(chunk)
+
+    logger.info("Loaded {n} days of training data from the database".format(n=filled))
+    dates, values = dates[:filled], values[:filled]
+
+    weather_data = pd.DataFrame(values[:, :-1], columns=weather_columns)
+    weather_data.insert(0, DATE_COLUMN, dates)
+    visitor_data = pd.DataFrame({DATE_COLUMN: dates,
+                                 'visitors': values[:, -1].astype(np.int64),
+                                 'weekday': weekdays_for_dates(dates)},
+                                columns=[DATE_COLUMN, 'visitors', 'weekday'])
+    return weather_data, visitor_data
+
+
+def import_csv(store, visitor_data_path=None, weather_data_path=None):
+    if visitor_data_path:
+        store.write('visitors', pd.read_csv(visitor_data_path))
+    if weather_data_path:
+        store.write('weather', pd.read_csv(weather_data_path))
+
+
+def import_excel(store, months):
+    # imported here so that openpyxl is only needed for Excel imports
+    from tools.oldZooDataExtractor import oldZooDataExtractor
+
+    extractor = oldZooDataExtractor(history=True, months=months)
+    rows = [(datetime.date(year, month, day), visitors) for day, month, year, visitors in extractor.output
+            if visitors is not None]
+    store.write('visitors', pd.DataFrame(rows, columns=[DATE_COLUMN, 'visitors']))
+
+
+def export_database(store, app):
+    """
+    Copies the weather observations and actual visitor counts from the database into the store.
+    """
+    with app.app_context():
+        session = models.db.session
+        weather_query = session.query(models.WeatherObservation.date.label(DATE_COLUMN),
+                                      models.WeatherObservation.precipitation,
+                                      models.WeatherObservation.temp_mean,
+                                      models.WeatherObservation.temp_min,
+                                      models.WeatherObservation.temp_max)
+        visitors_query = session.query(models.ZooStatisticActual.date.label(DATE_COLUMN),
+                                       models.ZooStatisticActual.visitors)
+
+        weather_data = pd.read_sql(weather_query.statement, session.bind)
+        visitor_data = pd.read_sql(visitors_query.statement, session.bind)
+
+    if len(weather_data):
+        store.write('weather', weather_data)
+    if len(visitor_data):
+        store.write('visitors', visitor_data)
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--store-path', dest='store_path', default=DEFAULT_STORE_PATH,
+                        help='path to the dataset store directory')
+    parser.add_argument('-w', '--weather-data-path', dest='weather_data_path',
+                        help='import weather data from this CSV file')
+    parser.add_argument('-v', '--visitor-data-path', dest='visitor_data_path',
+                        help='import visitor data from this CSV file')
+    parser.add_argument('-x', '--from-excel', dest='from_excel', action='store_true',
+                        help='import visitor data from the original Excel workbooks in data/')
+    parser.add_argument('-m', '--months', dest='months', type=int, nargs='+', default=[1, 2, 3],
+                        help='months to import from the Excel workbooks')
+    parser.add_argument('-d', '--from-database', dest='from_database', action='store_true',
+                        help='import weather observations and actual visitor counts from the database')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    store = DatasetStore(args.store_path)
+
+    import_csv(store, args.visitor_data_path, args.weather_data_path)
+    if args.from_excel:
+        import_excel(store, args.months)
+    if args.from_database:
+        export_database(store, appfactory.create_app(__name__))
+
+    for table in sorted(TABLES):
+        print("{t}: years {y}".format(t=table, y=store.partitions(table)))
+
+if __name__ == "__main__":
+    main()
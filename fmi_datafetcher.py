@@ -11,6 +11,7 @@ import logging
 import requests
 
 import fmi_parser
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -42,11 +43,7 @@ def get_daily_fmi_weather_forecast(location, start_date, end_date, api_key):
                               start_time=start_time.isoformat(),
                               end_time=end_time.isoformat(),
                               api_key=api_key)
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        raise IOError("Fetching data failed with status code {s}".format(s=resp.status_code))
-    if len(resp.text) == 0:
-        raise IOError("Got empty response to data request")
+    resp = _fetch(url, 'forecast')
 
     parser = fmi_parser.FMIWeatherForecastParser()
     parser.parse(resp.text, location)
@@ -68,17 +65,32 @@ def get_daily_fmi_weather_observations(location, start_date, end_date, api_key):
         + "starttime={start_date}&endtime={end_date}&"
 
     url = url_template.format(location=location, start_date=start_date, end_date=end_date, api_key=api_key)
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        raise IOError("Fetching data failed with status code {s}".format(s=resp.status_code))
-    if len(resp.text) == 0:
-        raise IOError("Got empty response to data request")
+    resp = _fetch(url, 'observations')
 
     parser = fmi_parser.FMIWeatherObservationParser()
     parser.parse(resp.text)
     return parser.get_observations()
 
 
+def _fetch(url, query):
+    """
+    Performs an HTTP GET request to the FMI service and records its duration and outcome.
+    :param url: the request URL
+    :param query: a short name for the kind of query, used as a metric label
+    :return: the response
+    """
+    with metrics.histogram("fmi_http_request_seconds", "Duration of HTTP requests to FMI").time(query=query):
+        resp = requests.get(url)
+    metrics.counter("fmi_http_requests_total", "HTTP requests to FMI").inc(query=query, status=resp.status_code)
+
+    if resp.status_code != 200:
+        raise IOError("Fetching data failed with status code {s}".format(s=resp.status_code))
+    if len(resp.text) == 0:
+        raise IOError("Got empty response to data request")
+    metrics.counter("fmi_http_response_bytes_total", "Bytes received from FMI").inc(len(resp.text), query=query)
+    return resp
+
+
 def write_weather_observations(observations, outstream):
     obs_sorted = sorted(observations, key=lambda o: o.date)
     obs_dicts = [o.as_dict() for o in obs_sorted]
@@ -3,19 +3,23 @@
 #
 # This module provides a command-line tool for harvesting current
 # weather and zoo visitor data from online sources.
-# The command-line harvester should be set to automatically run once a day.
+# The command-line harvester should be set to automatically run once a day,
+# e.g. by the in-process scheduler (scheduler.py).
 
+import argparse
 import datetime
 import logging
 import logging.config
 import os
 
-from flask import Flask
-
+import appfactory
+import checkpoints
 import config
 import fmi_datafetcher
+import metrics
 import models
-import train
+import predictor
+import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -26,10 +30,30 @@ class FMIHarvester(object):
         self._app = app
 
     def harvest(self):
+        """
+        Harvests the weather forecast for the next day, with a visitor
+        prediction, and the weather observations of all recent dates missing
+        from the database. A failure of one, e.g. a network or a database
+        error, does not keep the other from being harvested; the first failure
+        is re-raised afterwards.
+        """
         logger.info("Running data harvester")
-        db = models.db
 
         fmi_api_key = _get_fmi_api_key(self._app.config['FMI_API_KEY_PATH'])
+
+        failures = []
+        for step in (self.harvest_forecasts, self.harvest_observations):
+            try:
+                step(fmi_api_key)
+            except Exception as e:
+                logger.exception("Harvesting step {s} failed".format(s=step.__name__))
+                failures.append(e)
+
+        if failures:
+            raise failures[0]
+
+    def harvest_forecasts(self, fmi_api_key):
+        db = models.db
         location = self._app.config['FMI_WEATHER_LOCATION']
 
         # retrieve FMI weather forecast for the next day
@@ -38,34 +62,83 @@ class FMIHarvester(object):
 
         date = today + offset
 
+        with self._app.app_context():
+            if not checkpoints.missing_dates(checkpoints.FMI_FORECAST, date, date, models.WeatherForecast):
+                logger.info("FMI weather forecast for {d} has already been harvested".format(d=str(date)))
+                return
+
         logger.info("Fetching FMI weather forecast data for {d}".format(d=str(date)))
         forecasts = fmi_datafetcher.get_daily_fmi_weather_forecast(location, date, date, fmi_api_key)
 
         with self._app.app_context():
-            classifier = models.Classifier.query.first()
-            regression_model = models.RegressionModel.query.first()
+            registry = predictor.model_registry
+            registry.refresh_if_stale(self._app.config['MODEL_REFRESH_INTERVAL'])
+
+            logging.debug("Using classifiers: {c}".format(c=", ".join(m.name for m in registry.classifiers)))
+            logging.debug("Using regression models: {r}".format(
+                r=", ".join(m.name for m in registry.regression_models)))
 
-            logging.debug("Using classifier: {c}".format(c=classifier.name))
-            logging.debug("Using regression model: {r}".format(r=regression_model.name))
+            predicted_classes, predicted_visitors, predicted_quantiles, predicted_members = \
+                registry.predict_with_members(forecasts)
 
-            for forecast in forecasts:
+            for forecast, visitors_class, visitors, quantiles, members in zip(forecasts, predicted_classes,
+                                                                              predicted_visitors, predicted_quantiles,
+                                                                              predicted_members):
                 logger.debug("Got forecast: {f}".format(f=str(forecast)))
                 db.session.add(forecast)
 
-                predictors = train.weather_to_predictors([forecast])
+                prediction = models.ZooStatisticPrediction(forecast.date, visitors, visitors_class)
+                prediction.set_quantiles(quantiles, registry.quantiles)
+                prediction.regression_model_id = registry.regression_model_id
+                prediction.classifier_id = registry.classifier_id
+                prediction.members = [models.ZooStatisticPredictionMember(**predictor.member_columns(member))
+                                      for member in members]
+
+                db.session.add(prediction)
+            checkpoints.mark_harvested(checkpoints.FMI_FORECAST, [forecast.date for forecast in forecasts])
+            models.bump_data_version()
+
+            with metrics.histogram("db_commit_seconds", "Duration of database commits").time(job='fmi_harvester'):
+                db.session.commit()
+            metrics.counter("harvested_rows_total", "Rows stored by the harvesters")\
+                   .inc(2 * len(forecasts), job='fmi_harvester')
+
+    def harvest_observations(self, fmi_api_key):
+        """
+        Fetches the weather observations of all dates in the backfill window
+        that have not been harvested yet, with a single request covering them.
+        """
+        db = models.db
+        location = self._app.config['FMI_OBSERVATION_LOCATION']
+        today = datetime.datetime.now().date()
+        start, end = checkpoints.backfill_window(today, self._app.config['HARVEST_BACKFILL_DAYS'])
+
+        with self._app.app_context():
+            missing = checkpoints.missing_dates(checkpoints.FMI_OBSERVATION, start, end, models.WeatherObservation)
+        if not missing:
+            return
 
-                predicted_class = classifier.model.predict(predictors)[0].item()
-                predicted_visitors = regression_model.model.predict(predictors)[0].item()
+        logger.info("Fetching FMI weather observations for {n} dates from {a} to {b}".format(
+            n=len(missing), a=missing[0], b=missing[-1]))
+        observations = fmi_datafetcher.get_daily_fmi_weather_observations(location, missing[0], missing[-1],
+                                                                           fmi_api_key)
 
-                prediction = models.ZooStatisticPrediction(forecast.date,
-                                                           predicted_visitors,
-                                                           predicted_class,
-                                                           regression_model,
-                                                           classifier)
+        # the range may include dates already harvested, and the observations
+        # of the latest days may not be complete yet; those are fetched again later
+        wanted = set(missing)
+        observations = [o for o in observations if o.date in wanted and o.temp_max is not None]
 
-                db.session.add(prediction)
+        with self._app.app_context():
+            db.session.add_all(observations)
+            checkpoints.mark_harvested(checkpoints.FMI_OBSERVATION, [o.date for o in observations])
 
-            db.session.commit()
+            with metrics.histogram("db_commit_seconds", "Duration of database commits").time(job='fmi_harvester'):
+                db.session.commit()
+            metrics.counter("harvested_rows_total", "Rows stored by the harvesters")\
+                   .inc(len(observations), job='fmi_harvester')
+
+        logger.info("Stored weather observations for {n} of {m} missing dates".format(n=len(observations),
+                                                                                       m=len(missing)))
 
 
 def _get_fmi_api_key(api_key_path):
@@ -81,15 +154,26 @@ def _get_fmi_api_key(api_key_path):
     return api_key
 
 
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        default=profiling.is_enabled_by_environment(),
+                        help='profile the harvester run and write a report into PROFILE_OUTPUT_DIR')
+    return parser
+
+
 def main():
     logging.config.dictConfig(config.LOGGING_CONF)
 
-    app = Flask(__name__)
-    app.config.from_object("config")
-    models.db.init_app(app)
+    args = _get_arg_parser().parse_args()
+
+    app = appfactory.create_app(__name__)
 
     harvester = FMIHarvester(app)
-    harvester.harvest()
+    with profiling.profiled('fmi_harvester', app.config['PROFILE_OUTPUT_DIR'], enabled=args.profile):
+        harvester.harvest()
+
+    metrics.dump_json_if_configured(app.config)
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,7 @@
 
 import xml.etree.ElementTree as ElementTree
 
+import metrics
 import models
 
 import datetime
@@ -26,9 +27,14 @@ class FMIWeatherObservationParser(object):
     def __init__(self):
         self.observations = {}
 
+    @metrics.timed("fmi_parse_seconds", "Time spent parsing FMI XML responses", parser='observation')
     def parse(self, input_string):
         root = ElementTree.fromstring(input_string)
-        for element in root.findall('./wfs:member/BsWfs:BsWfsElement', namespaces=namespaces):
+        elements = root.findall('./wfs:member/BsWfs:BsWfsElement', namespaces=namespaces)
+        metrics.counter("fmi_parsed_elements_total", "Data elements parsed from FMI XML responses")\
+               .inc(len(elements), parser='observation')
+
+        for element in elements:
             timestamp_str = element.find('BsWfs:Time', namespaces=namespaces).text
             date = parse_fmi_date(timestamp_str)
 
@@ -59,15 +65,19 @@ class FMIWeatherForecastParser(object):
     def __init__(self):
         self.forecasts = {}
 
+    @metrics.timed("fmi_parse_seconds", "Time spent parsing FMI XML responses", parser='forecast')
     def parse(self, input_string, location):
         logger.debug("Parsing weather forecast from XML string")
         location = location.strip()
         root = ElementTree.fromstring(input_string)
+        elements = root.findall('./wfs:member/BsWfs:BsWfsElement', namespaces=namespaces)
+        metrics.counter("fmi_parsed_elements_total", "Data elements parsed from FMI XML responses")\
+               .inc(len(elements), parser='forecast')
 
         # keep track of all the temperature readings for each day so that a mean can be computed
         hourly_temperatures = {}
 
-        for element in root.findall('./wfs:member/BsWfs:BsWfsElement', namespaces=namespaces):
+        for element in elements:
             datapoint_location = element.find('BsWfs:Location', namespaces=namespaces)\
                                         .find('gml:Point', namespaces=namespaces)\
                                         .find('gml:pos', namespaces=namespaces).text.strip()
@@ -0,0 +1,31 @@
+# gunicorn configuration for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Run with: gunicorn --config gunicorn.conf.py wsgi:app
+#
+# Sending SIGHUP to the master restarts the workers gracefully. Newly trained
+# models do not need a restart: each worker checks the database for them every
+# MODEL_REFRESH_INTERVAL seconds.
+
+import multiprocessing
+import os
+
+bind = "0.0.0.0:{p}".format(p=os.environ.get('PORT', 5000))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = "sync"
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = 30
+
+# import the app and load the models once in the master process
+preload_app = True
+
+# recycle workers now and then to keep memory use in check
+max_requests = 1000
+max_requests_jitter = 100
+
+
+def post_fork(server, worker):
+    # never reuse database connections inherited from the master process
+    import models
+    from zoopredict_web import app
+    models.db.get_engine(app).dispose()
@@ -2,12 +2,17 @@
 
 # Database initialization utility for ZooPredict.
 # Populates the database based on the application-wide configuration
-# and persistence models.
+# and persistence models. Run on an existing database, it also adds the
+# columns that newer persistence models have to the existing tables, e.g.
+# the active and weight columns of the classifier and regression_model tables.
 
 from __future__ import print_function
 
 import argparse
-from flask import Flask
+
+import sqlalchemy
+
+import appfactory
 import models
 
 
@@ -23,9 +28,50 @@ def initdb(app, drop_existing=False):
             db.drop_all()
         print("Creating tables")
         db.create_all()
+        for column in add_missing_columns(db):
+            print("Added column {c}".format(c=column))
         db.session.commit()
 
 
+def add_missing_columns(db):
+    """
+    Adds the columns of the persistence models that are missing from existing
+    tables; create_all() only creates missing tables. Foreign key constraints
+    are not added. Must be called within an app context.
+    :return: the added columns as "table.column" strings
+    :raises ValueError: if a missing column is NOT NULL without a default value
+    """
+    engine = db.engine
+    preparer = engine.dialect.identifier_preparer
+    inspector = sqlalchemy.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    added = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            definition = "{c} {t}".format(c=preparer.quote(column.name), t=column.type.compile(dialect=engine.dialect))
+            default = column.default.arg if column.default is not None and column.default.is_scalar else None
+            if default is not None:
+                literal = sqlalchemy.literal(default, type_=column.type)
+                definition += " DEFAULT {d}".format(
+                    d=literal.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+            if not column.nullable:
+                if default is None:
+                    raise ValueError("Cannot add the NOT NULL column {t}.{c} without a default value".format(
+                        t=table.name, c=column.name))
+                definition += " NOT NULL"
+
+            db.session.execute("ALTER TABLE {t} ADD COLUMN {d}".format(t=preparer.quote(table.name), d=definition))
+            added.append("{t}.{c}".format(t=table.name, c=column.name))
+    return added
+
+
 def _get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--drop-existing', dest='drop_existing',
@@ -35,8 +81,7 @@ def _get_arg_parser():
 
 
 def main():
-    app = Flask(__name__)
-    app.config.from_object("config")
+    app = appfactory.create_app(__name__)
 
     argparser = _get_arg_parser()
     args = argparser.parse_args()
@@ -0,0 +1,220 @@
+# Lightweight instrumentation for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Provides in-process counters and histograms that the harvesters, the trainer
+# and the web app use to record timings and counts. The collected values can
+# be rendered in the Prometheus text exposition format (served by the web app
+# at /metrics) or dumped as JSON at the end of a batch job.
+#
+# Note that the registry is per process: when the web app runs with several
+# worker processes, each worker reports its own values.
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# histogram bucket upper bounds in seconds, suitable for request latencies,
+# HTTP calls and model fitting alike
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=None):
+    items = list(label_key)
+    if extra:
+        items.extend(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{k}="{v}"'.format(k=k, v=str(v).replace('"', '\\"')) for k, v in items) + "}"
+
+
+class Counter(object):
+    """
+    A monotonically increasing counter, optionally split by labels.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def as_dict(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in sorted(self._values.items())]
+
+
+class Histogram(object):
+    """
+    A histogram of observed values with cumulative buckets, optionally split by labels.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Context manager that observes the wall clock time spent in its body, in seconds.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        series = self._series.get(_label_key(labels))
+        return series['count'] if series else 0
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, series['buckets']):
+                    result.append((self.name + "_bucket", key + (('le', repr(bound)),), bucket_count))
+                result.append((self.name + "_bucket", key + (('le', '+Inf'),), series['count']))
+                result.append((self.name + "_count", key, series['count']))
+                result.append((self.name + "_sum", key, series['sum']))
+        return result
+
+    def as_dict(self):
+        with self._lock:
+            return [{'labels': dict(key), 'count': series['count'], 'sum': series['sum'],
+                     'buckets': dict(zip([repr(b) for b in self.buckets], series['buckets']))}
+                    for key, series in sorted(self._series.items())]
+
+
+class MetricsRegistry(object):
+    """
+    A collection of named metrics. Metrics are created on first use, so
+    modules can simply ask for the metric they want to update.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric {n} is already registered as a {k}".format(n=name, k=metric.kind))
+            return metric
+
+    def counter(self, name, description=""):
+        return self._get_or_create(Counter, name, description)
+
+    def histogram(self, name, description="", buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def render_prometheus(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        :return: the metrics as a string
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            if metric.description:
+                lines.append("# HELP {n} {d}".format(n=name, d=metric.description))
+            lines.append("# TYPE {n} {k}".format(n=name, k=metric.kind))
+            for sample_name, label_key, value in metric.samples():
+                lines.append("{n}{l} {v}".format(n=sample_name, l=_format_labels(label_key), v=repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        return {name: {'type': metric.kind, 'description': metric.description, 'values': metric.as_dict()}
+                for name, metric in sorted(self._metrics.items())}
+
+    def dump_json(self, path):
+        """
+        Writes all metrics into a JSON file.
+        :param path: the output file path
+        """
+        logger.debug("Writing metrics into {p}".format(p=path))
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+registry = MetricsRegistry()
+
+
+def counter(name, description=""):
+    return registry.counter(name, description)
+
+
+def histogram(name, description="", buckets=DEFAULT_BUCKETS):
+    return registry.histogram(name, description, buckets=buckets)
+
+
+def timed(name, description="", **labels):
+    """
+    Decorator that records the duration of each call of the decorated function
+    into the named histogram.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram(name, description).time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump_json_if_configured(app_config):
+    """
+    Dumps the metrics as JSON if METRICS_JSON_PATH is set in the given
+    configuration. Meant to be called at the end of batch jobs.
+    :param app_config: a Flask app config or other mapping
+    """
+    path = app_config.get('METRICS_JSON_PATH')
+    if path:
+        registry.dump_json(path)
@@ -3,7 +3,35 @@
 
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+_POOL_OPTIONS = ('pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow')
+
+
+class ZooPredictSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension with the engine options ZooPredict needs on top
+    of the pool settings Flask-SQLAlchemy supports out of the box.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # the pool settings are meant for server databases: an in-memory
+            # database lives in a single static connection, and file databases
+            # get a NullPool, which rejects them
+            for option in _POOL_OPTIONS:
+                options.pop(option, None)
+
+        super(ZooPredictSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+        if not info.drivername.startswith('sqlite'):
+            options['pool_pre_ping'] = app.config.get('SQLALCHEMY_POOL_PRE_PING', True)
+
+        statement_timeout = app.config.get('DATABASE_STATEMENT_TIMEOUT_MS')
+        if statement_timeout and info.drivername.startswith('postgres'):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = "-c statement_timeout={t:d}".format(t=statement_timeout)
+
+
+db = ZooPredictSQLAlchemy()
 
 
 class DailyWeather(db.Model):
@@ -58,6 +86,38 @@ class WeatherForecast(DailyWeather):
     __tablename__ = "weather_forecast"
 
 
+class ForecastError(db.Model):
+    """
+    Persistence model for the difference between the weather forecast and the
+    observed weather on a single day, and the visitor prediction re-scored
+    with the observed weather. Filled in by the reconciliation job.
+    """
+
+    __tablename__ = "forecast_error"
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, unique=True)
+    # plain ids rather than foreign keys, so that old forecasts and models can
+    # be removed without touching the reconciliation history
+    forecast_id = db.Column(db.Integer)
+    observation_id = db.Column(db.Integer)
+
+    # errors are forecast value minus observed value
+    temp_max_error = db.Column(db.Float)
+    temp_min_error = db.Column(db.Float)
+    temp_mean_error = db.Column(db.Float)
+    precipitation_error = db.Column(db.Float)
+
+    # visitor prediction made with the observed instead of the forecast weather;
+    # the model ids are only set for a single model, the members of an ensemble
+    # are stored in forecast_error_member
+    rescored_visitors = db.Column(db.Integer)
+    rescored_visitors_class = db.Column(db.Integer)
+    rescored_classifier_id = db.Column(db.Integer)
+    rescored_regression_model_id = db.Column(db.Integer)
+    rescored_members = db.relationship('ForecastErrorMember', cascade='all, delete-orphan')
+
+
 class ZooStatistic(db.Model):
     """
     Base class for zoo visitor statistic persistence models.
@@ -90,16 +150,204 @@ class ZooStatisticPrediction(ZooStatistic):
 
     __tablename__ = 'zoo_statistic_prediction'
 
+    # predicted quantiles of the visitor count (config.PREDICTION_QUANTILES)
+    visitors_low = db.Column(db.Integer)
+    visitors_median = db.Column(db.Integer)
+    visitors_high = db.Column(db.Integer)
+
     classifier_id = db.Column(db.Integer, db.ForeignKey('classifier.id'))
     regression_model_id = db.Column(db.Integer, db.ForeignKey('regression_model.id'))
     classifier = db.relationship('Classifier', foreign_keys=classifier_id)
     regression_model = db.relationship('RegressionModel', foreign_keys=regression_model_id)
+    members = db.relationship('ZooStatisticPredictionMember', cascade='all, delete-orphan')
 
     def __init__(self, date, visitors, visitors_class, regression_model=None, classifier=None):
         super(ZooStatisticPrediction, self).__init__(date, visitors, visitors_class)
         self.regression_model = regression_model
         self.classifier = classifier
 
+    def set_quantiles(self, quantiles, levels):
+        """
+        Stores the predicted quantiles of the visitor count: the lowest, the
+        median and the highest of them. Does nothing if quantiles is None.
+        The median is left empty if the levels do not include 0.5.
+        :param quantiles: list of predicted quantiles
+        :param levels: the quantile levels predicted by the model in increasing order, e.g. [0.1, 0.5, 0.9]
+        """
+        if quantiles is None:
+            return
+        median = median_index(levels)
+        self.visitors_low = int(round(quantiles[0]))
+        self.visitors_median = int(round(quantiles[median])) if median is not None else None
+        self.visitors_high = int(round(quantiles[-1]))
+
+
+def median_index(levels):
+    """
+    Returns the index of the median (0.5) in the given quantile levels, or None if it is not included.
+    """
+    for i, level in enumerate(levels):
+        if abs(level - 0.5) < 1e-9:
+            return i
+    return None
+
+
+class PredictionMember(db.Model):
+    """
+    Base class for persistence models of the prediction of a single model in
+    an ensemble prediction. The model ids are not foreign keys, so that the
+    member predictions are kept when the models are replaced by retraining.
+    """
+    __abstract__ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    classifier_id = db.Column(db.Integer)
+    regression_model_id = db.Column(db.Integer)
+    name = db.Column(db.String)
+    visitors = db.Column(db.Float)
+    visitors_class = db.Column(db.Integer)
+
+    def __init__(self, name, classifier_id=None, regression_model_id=None, visitors=None, visitors_class=None):
+        self.name = name
+        self.classifier_id = classifier_id
+        self.regression_model_id = regression_model_id
+        self.visitors = visitors
+        self.visitors_class = visitors_class
+
+
+class ZooStatisticPredictionMember(PredictionMember):
+    """
+    Persistence model for a member prediction of a stored visitor prediction.
+    """
+
+    __tablename__ = 'zoo_statistic_prediction_member'
+
+    prediction_id = db.Column(db.Integer, db.ForeignKey('zoo_statistic_prediction.id'), nullable=False,
+                              index=True)
+
+
+class ForecastErrorMember(PredictionMember):
+    """
+    Persistence model for a member prediction of a visitor prediction
+    re-scored with the observed weather by the reconciliation job.
+    """
+
+    __tablename__ = 'forecast_error_member'
+
+    forecast_error_id = db.Column(db.Integer, db.ForeignKey('forecast_error.id'), nullable=False, index=True)
+
+
+class WeatherForecastMonthly(db.Model):
+    """
+    Persistence model for monthly aggregates of daily weather forecasts that
+    have been removed from the weather_forecast table by the retention job.
+    """
+
+    __tablename__ = "weather_forecast_monthly"
+    __table_args__ = (db.UniqueConstraint('year', 'month'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    days = db.Column(db.Integer, nullable=False)
+    temp_max = db.Column(db.Float)
+    temp_min = db.Column(db.Float)
+    temp_mean = db.Column(db.Float)
+    precipitation = db.Column(db.Float)
+
+
+class ZooStatisticPredictionMonthly(db.Model):
+    """
+    Persistence model for monthly aggregates of daily visitor predictions that
+    have been removed from the zoo_statistic_prediction table by the retention job.
+    The sums allow computing mean errors over any range of months.
+    """
+
+    __tablename__ = "zoo_statistic_prediction_monthly"
+    __table_args__ = (db.UniqueConstraint('year', 'month'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    days = db.Column(db.Integer, nullable=False)
+    visitors_sum = db.Column(db.Integer, nullable=False)
+    days_with_actual = db.Column(db.Integer, nullable=False)
+    absolute_error_sum = db.Column(db.Float)
+    squared_error_sum = db.Column(db.Float)
+    class_hits = db.Column(db.Integer)
+
+
+class DataVersion(db.Model):
+    """
+    Persistence model for a counter that is incremented whenever the data shown
+    in the web UI changes, so that cached page fragments can be invalidated.
+    """
+
+    __tablename__ = "data_version"
+
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+
+class HarvestCheckpoint(db.Model):
+    """
+    Persistence model for a date whose data a harvester has stored, per data source.
+    """
+
+    __tablename__ = "harvest_checkpoint"
+    __table_args__ = (db.UniqueConstraint('source', 'date'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    harvested_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, source, date, harvested_at):
+        self.source = source
+        self.date = date
+        self.harvested_at = harvested_at
+
+
+class JobLock(db.Model):
+    """
+    Persistence model for a lock held by a scheduled job, so that the same job
+    is never run concurrently by several scheduler processes. A lock whose
+    expires_at has passed is considered released.
+    """
+
+    __tablename__ = "job_lock"
+
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(128), nullable=False)
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class JobRun(db.Model):
+    """
+    Persistence model for a single run of a scheduled job.
+    """
+
+    __tablename__ = "job_run"
+
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(64), nullable=False, index=True)
+    owner = db.Column(db.String(128))
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    seconds = db.Column(db.Float)
+    succeeded = db.Column(db.Boolean)
+    error = db.Column(db.String(1000))
+
+    def __init__(self, job, owner, started_at):
+        self.job = job
+        self.owner = owner
+        self.started_at = started_at
+
 
 class PredictionModel(db.Model):
     """
@@ -112,14 +360,21 @@ class PredictionModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     model = db.Column(db.PickleType, nullable=False)
     name = db.Column(db.String)
+    # all active models are used for prediction, as an ensemble if there are several
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    weight = db.Column(db.Float, nullable=False, default=1.0)
 
-    def __init__(self, model, name=None):
+    def __init__(self, model, name=None, weight=1.0, active=True):
         """
         Initializes a new prediction model persistence instance.
         :param model: the prediction model object
+        :param weight: the weight of the model's predictions in an ensemble
+        :param active: whether the model is used for prediction
         """
         self.model = model
         self.name = name
+        self.weight = weight
+        self.active = active
 
 
 class RegressionModel(PredictionModel):
@@ -147,3 +402,44 @@ def get_zoo_predictions_and_actuals():
                         .add_entity(ZooStatisticActual)\
                         .all()
     return results
+
+
+def get_prediction_members(prediction_ids):
+    """
+    Returns the ensemble member predictions of the given visitor predictions.
+    :param prediction_ids: ids of ZooStatisticPrediction rows
+    :return: dict of lists of ZooStatisticPredictionMember objects by prediction id
+    """
+    members = {}
+    if not prediction_ids:
+        return members
+    rows = ZooStatisticPredictionMember.query\
+                                       .filter(ZooStatisticPredictionMember.prediction_id.in_(prediction_ids))\
+                                       .order_by(ZooStatisticPredictionMember.id)
+    for member in rows:
+        members.setdefault(member.prediction_id, []).append(member)
+    return members
+
+
+DATA_VERSION_NAME = 'zoo_statistics'
+
+
+def get_data_version():
+    """
+    Returns the current version of the visitor predictions and actual values,
+    or 0 if they have never been changed since versioning was added.
+    """
+    version = db.session.query(DataVersion.version).filter(DataVersion.name == DATA_VERSION_NAME).scalar()
+    return version or 0
+
+
+def bump_data_version():
+    """
+    Increments the version of the visitor predictions and actual values in the
+    current session. Call it before committing changes to them, so that the
+    new version is committed in the same transaction.
+    """
+    updated = db.session.query(DataVersion).filter(DataVersion.name == DATA_VERSION_NAME)\
+                        .update({DataVersion.version: DataVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(DataVersion(DATA_VERSION_NAME, 1))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Prediction model management for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Lists the classifiers and regression models stored in the database and
+# activates or deactivates them. All active models are used for prediction, as
+# an ensemble if there are several; running processes pick up the change when
+# they next check for new models (MODEL_REFRESH_INTERVAL).
+
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import logging.config
+
+import appfactory
+import config
+import models
+import predictor
+
+logger = logging.getLogger(__name__)
+
+# the persistence model of each kind of prediction model
+MODEL_CLASSES = collections.OrderedDict([
+    (predictor.CLASSIFIER, models.Classifier),
+    (predictor.REGRESSION_MODEL, models.RegressionModel),
+])
+
+
+def set_active(kind, model_id, active):
+    """
+    Activates or deactivates a stored prediction model. Must be called within an app context.
+    :param kind: the kind of the model, predictor.CLASSIFIER or predictor.REGRESSION_MODEL
+    :param model_id: the database id of the model
+    :param active: whether the model is used for prediction
+    :raises LookupError: if there is no such model
+    """
+    model_class = MODEL_CLASSES[kind]
+    updated = model_class.query.filter(model_class.id == model_id)\
+                               .update({model_class.active: active}, synchronize_session=False)
+    if not updated:
+        raise LookupError("No {k} with id {i}".format(k=kind, i=model_id))
+    models.db.session.commit()
+    logger.info("{a} {k} {i}".format(a="Activated" if active else "Deactivated", k=kind, i=model_id))
+
+
+def _print_models():
+    for kind, model_class in MODEL_CLASSES.items():
+        for model in model_class.query.order_by(model_class.id):
+            print("{k:16s} {i:6d}  {n:24s} weight {w:<6g} {a}".format(
+                k=kind, i=model.id, n=model.name or '', w=model.weight, a="active" if model.active else "inactive"))
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--activate', dest='activate', nargs=2, action='append', default=[],
+                        metavar=('KIND', 'ID'),
+                        help='activate the model of the given kind (classifier or regression_model) and id; '
+                             'may be repeated')
+    parser.add_argument('-d', '--deactivate', dest='deactivate', nargs=2, action='append', default=[],
+                        metavar=('KIND', 'ID'),
+                        help='deactivate the model of the given kind and id; may be repeated')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    argparser = _get_arg_parser()
+    args = argparser.parse_args()
+    changes = [(kind, model_id, True) for kind, model_id in args.activate] + \
+              [(kind, model_id, False) for kind, model_id in args.deactivate]
+    for kind, model_id, _ in changes:
+        if kind not in MODEL_CLASSES or not model_id.isdigit():
+            argparser.error("invalid model {k} {i}; the kind is one of {c}".format(
+                k=kind, i=model_id, c=", ".join(MODEL_CLASSES)))
+
+    app = appfactory.create_app(__name__)
+    with app.app_context():
+        for kind, model_id, active in changes:
+            try:
+                set_active(kind, int(model_id), active)
+            except LookupError as e:
+                argparser.error(str(e))
+        _print_models()
+
+if __name__ == "__main__":
+    main()
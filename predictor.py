@@ -0,0 +1,330 @@
+# Prediction model access for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Keeps the active classifiers and regression models in memory so that they
+# are unpickled once per process instead of once per use. Several active models
+# per task are combined into an ensemble prediction. In the production web
+# server the models are loaded in the master process before the workers are
+# forked, and every process reloads them when newer models have been trained.
+#
+# Predictions are pure functions of the models and the (quantized) features,
+# so they are cached in a bounded LRU cache with a time-to-live.
+
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import cache
+import config
+import metrics
+import models
+import train
+
+logger = logging.getLogger(__name__)
+
+# A prediction model loaded into memory. Only plain values are kept so that
+# the models stay usable after the database session they came from is closed.
+LoadedModel = collections.namedtuple('LoadedModel', ['id', 'name', 'model', 'weight'])
+
+CLASSIFIER = 'classifier'
+REGRESSION_MODEL = 'regression_model'
+
+# The prediction of a single member of an ensemble: the kind of the model
+# (CLASSIFIER or REGRESSION_MODEL), its database id and name, and the
+# predicted visitor class or visitor count
+MemberPrediction = collections.namedtuple('MemberPrediction', ['kind', 'model_id', 'name', 'value'])
+
+
+class ModelRegistry(object):
+    """
+    Holds the prediction models currently in use.
+
+    Any number of classifiers and regression models may be active at a time.
+    Their predictions are combined into an ensemble prediction: a weighted
+    vote of the classifiers and a weighted average of the regression models.
+    The members predict over the same feature matrix in parallel threads.
+
+    The models are identified by their database ids and weights;
+    refresh_if_stale() compares those to the database and reloads the models
+    when training has stored new ones.
+    """
+
+    def __init__(self, cache_size=config.PREDICTION_CACHE_SIZE, cache_ttl=config.PREDICTION_CACHE_TTL,
+                 quantization_step=config.PREDICTION_CACHE_QUANTIZATION_STEP, workers=config.PREDICTION_WORKERS):
+        self.classifiers = []
+        self.regression_models = []
+        self.version = None
+        self.cache = cache.TTLCache(cache_size, cache_ttl, metric_prefix='prediction_cache')
+        self.quantization_step = quantization_step
+        self.workers = workers
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    @property
+    def classifier_id(self):
+        """
+        The id of the classifier in use, or None if an ensemble of several is in use.
+        """
+        return self.classifiers[0].id if len(self.classifiers) == 1 else None
+
+    @property
+    def regression_model_id(self):
+        """
+        The id of the regression model in use, or None if an ensemble of several is in use.
+        """
+        return self.regression_models[0].id if len(self.regression_models) == 1 else None
+
+    @property
+    def quantiles(self):
+        """
+        The quantiles predicted by the loaded regression models, or None if
+        they do not all predict the same quantiles.
+        """
+        quantiles = [getattr(m.model, 'quantiles', None) for m in self.regression_models]
+        if not quantiles or any(q is None or q != quantiles[0] for q in quantiles):
+            return None
+        return quantiles[0]
+
+    @staticmethod
+    def _active_models(model_class):
+        return model_class.query.filter(model_class.active.is_(True)).order_by(model_class.id).all()
+
+    @staticmethod
+    def _active_versions(model_class):
+        return tuple((row[0], row[1]) for row in models.db.session.query(model_class.id, model_class.weight)
+                                                                  .filter(model_class.active.is_(True))
+                                                                  .order_by(model_class.id))
+
+    def load(self):
+        """
+        Loads the active models from the database. Must be called within an app context.
+        """
+        classifiers = self._active_models(models.Classifier)
+        regression_models = self._active_models(models.RegressionModel)
+        if not classifiers or not regression_models:
+            raise LookupError("No trained models found in the database")
+
+        logger.info("Loaded classifiers {c} and regression models {r}".format(
+            c=", ".join(c.name for c in classifiers), r=", ".join(r.name for r in regression_models)))
+        with self._lock:
+            self.classifiers = [LoadedModel(c.id, c.name, c.model, c.weight) for c in classifiers]
+            self.regression_models = [LoadedModel(r.id, r.name, r.model, r.weight) for r in regression_models]
+            self.version = (tuple((c.id, c.weight) for c in classifiers),
+                            tuple((r.id, r.weight) for r in regression_models))
+            self._checked_at = time.time()
+            self.cache.clear()
+
+    def refresh_if_stale(self, max_age):
+        """
+        Reloads the models if they have not been checked within max_age seconds
+        and the database holds different models. Must be called within an app context.
+        :param max_age: the number of seconds after which the models are checked again
+        :return: True if the models were (re)loaded
+        """
+        if self.loaded and time.time() - self._checked_at < max_age:
+            return False
+
+        version = (self._active_versions(models.Classifier), self._active_versions(models.RegressionModel))
+        if not version[0] or not version[1]:
+            if not self.loaded:
+                raise LookupError("No trained models found in the database")
+            self._checked_at = time.time()
+            return False
+
+        if version == self.version:
+            self._checked_at = time.time()
+            return False
+
+        self.load()
+        return True
+
+    def predict(self, daily_weather_data):
+        """
+        Predicts visitor classes and visitor counts for a list of daily weather
+        forecasts or observations in one batch.
+        :param daily_weather_data: list of models.DailyWeather objects
+        :return: a tuple (list of visitor classes, list of visitor counts)
+        """
+        return self.predict_features([w.temp_max for w in daily_weather_data],
+                                     [w.precipitation for w in daily_weather_data],
+                                     [w.date.weekday() for w in daily_weather_data])
+
+    def predict_with_intervals(self, daily_weather_data):
+        """
+        Like predict, but also returns the predicted quantiles of the visitor
+        counts (config.PREDICTION_QUANTILES), computed in the same batch.
+        :param daily_weather_data: list of models.DailyWeather objects
+        :return: a tuple (list of visitor classes, list of visitor counts, list of
+                 quantile lists); a quantile list is None if a regression model
+                 predates quantile support
+        """
+        return self.predict_features_with_intervals([w.temp_max for w in daily_weather_data],
+                                                    [w.precipitation for w in daily_weather_data],
+                                                    [w.date.weekday() for w in daily_weather_data])
+
+    def predict_with_members(self, daily_weather_data):
+        """
+        Like predict_with_intervals, but also returns the predictions of the
+        individual ensemble members.
+        :param daily_weather_data: list of models.DailyWeather objects
+        :return: a tuple (list of visitor classes, list of visitor counts, list of
+                 quantile lists, list of lists of MemberPrediction tuples)
+        """
+        return self.predict_features_with_members([w.temp_max for w in daily_weather_data],
+                                                  [w.precipitation for w in daily_weather_data],
+                                                  [w.date.weekday() for w in daily_weather_data])
+
+    def predict_features(self, temps_max, precipitations, weekdays):
+        """
+        Predicts visitor classes and visitor counts from feature values.
+
+        The weather features are quantized to the configured step before
+        prediction, so that the results can be cached. Only the feature
+        vectors missing from the cache are passed to the models, in one batch.
+        :param temps_max: sequence of daily maximum temperatures
+        :param precipitations: sequence of daily precipitation totals
+        :param weekdays: sequence of weekday numbers (0 = Monday)
+        :return: a tuple (list of visitor classes, list of visitor counts)
+        """
+        classes, visitors, _ = self.predict_features_with_intervals(temps_max, precipitations, weekdays)
+        return classes, visitors
+
+    def predict_features_with_intervals(self, temps_max, precipitations, weekdays):
+        """
+        Like predict_features, but also returns the predicted quantiles of the
+        visitor counts; see predict_with_intervals.
+        """
+        results = self._predict_features(temps_max, precipitations, weekdays)
+        return [r[0] for r in results], [r[1] for r in results], [r[2] for r in results]
+
+    def predict_features_with_members(self, temps_max, precipitations, weekdays):
+        """
+        Like predict_features_with_intervals, but also returns the predictions
+        of the individual ensemble members; see predict_with_members.
+        """
+        results = self._predict_features(temps_max, precipitations, weekdays)
+        return [r[0] for r in results], [r[1] for r in results], [r[2] for r in results], [r[3] for r in results]
+
+    def _predict_features(self, temps_max, precipitations, weekdays):
+        with self._lock:
+            classifiers, regression_models, version = self.classifiers, self.regression_models, self.version
+        if version is None:
+            raise LookupError("Prediction models have not been loaded")
+
+        keys = [(version, self._quantize(t), self._quantize(p), int(w))
+                for t, p, w in zip(temps_max, precipitations, weekdays)]
+        results = [self.cache.get(key) for key in keys]
+
+        # predict each distinct missing feature vector once
+        missing_keys = list(collections.OrderedDict.fromkeys(key for key, result in zip(keys, results)
+                                                             if result is None))
+        if missing_keys:
+            X = train.features_to_matrix([key[1] * self.quantization_step for key in missing_keys],
+                                         [key[2] * self.quantization_step for key in missing_keys],
+                                         [key[3] for key in missing_keys])
+            predicted = dict(zip(missing_keys, self._predict_ensemble(classifiers, regression_models, X)))
+            for key in missing_keys:
+                self.cache.put(key, predicted[key])
+            results = [result if result is not None else predicted[key] for key, result in zip(keys, results)]
+
+        return results
+
+    def _predict_ensemble(self, classifiers, regression_models, X):
+        """
+        Runs all members over the feature matrix and combines their predictions.
+        :return: a list of (visitor class, visitor count, quantile list, member predictions) tuples, one per row
+        """
+        jobs = [(member, False) for member in classifiers] + [(member, True) for member in regression_models]
+        outputs = self._map(lambda job: _member_predict(job[0], X, with_quantiles=job[1]), jobs)
+        class_outputs = outputs[:len(classifiers)]
+        regression_outputs = outputs[len(classifiers):]
+
+        # weighted vote; ties go to the lowest class
+        class_weights = collections.defaultdict(lambda: np.zeros(len(X)))
+        for member, (classes, _) in zip(classifiers, class_outputs):
+            for visitors_class in np.unique(classes):
+                class_weights[visitors_class] += member.weight * (classes == visitors_class)
+        candidates = sorted(class_weights)
+        votes = np.array([class_weights[c] for c in candidates])
+        ensemble_classes = [candidates[i] for i in np.argmax(votes, axis=0)]
+
+        weights = np.array([member.weight for member in regression_models], dtype=np.float64)
+        ensemble_visitors = np.average(np.array([visitors for visitors, _ in regression_outputs]), axis=0,
+                                       weights=weights)
+
+        # the quantiles of the ensemble are approximated by averaging the
+        # members' quantiles, if all members predict the same quantiles
+        ensemble_quantiles = [None] * len(X)
+        member_quantiles = [quantiles for _, quantiles in regression_outputs]
+        if all(q is not None for q in member_quantiles) and \
+                len(set(tuple(m.model.quantiles) for m in regression_models)) == 1:
+            ensemble_quantiles = np.average(np.array(member_quantiles), axis=0, weights=weights).tolist()
+
+        results = []
+        for i in range(len(X)):
+            member_predictions = \
+                [MemberPrediction(CLASSIFIER, m.id, m.name, classes[i].item())
+                 for m, (classes, _) in zip(classifiers, class_outputs)] + \
+                [MemberPrediction(REGRESSION_MODEL, m.id, m.name, visitors[i].item())
+                 for m, (visitors, _) in zip(regression_models, regression_outputs)]
+            results.append((_item(ensemble_classes[i]), ensemble_visitors[i].item(), ensemble_quantiles[i],
+                            member_predictions))
+        return results
+
+    def _map(self, func, jobs):
+        """
+        Applies func to all jobs, in parallel threads if there are several.
+        """
+        if len(jobs) <= 1 or self.workers <= 1:
+            return [func(job) for job in jobs]
+        # threads do not survive a fork, so each process creates its own executor
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+            executor = self._executor
+        with metrics.histogram("ensemble_prediction_seconds", "Duration of parallel ensemble predictions").time():
+            return list(executor.map(func, jobs))
+
+    def _quantize(self, value):
+        return int(round(value / self.quantization_step))
+
+
+def member_columns(member):
+    """
+    Returns the column values of a stored member prediction (see models.PredictionMember).
+    :param member: a MemberPrediction
+    :return: dict of column values by column name
+    """
+    if member.kind == CLASSIFIER:
+        return {'name': member.name, 'classifier_id': member.model_id, 'visitors_class': member.value}
+    return {'name': member.name, 'regression_model_id': member.model_id, 'visitors': member.value}
+
+
+def _member_predict(member, X, with_quantiles):
+    """
+    :return: a tuple (predictions, quantiles or None) of a single model
+    """
+    quantiles = None
+    # models trained before quantile support only have point predictions
+    if with_quantiles and hasattr(member.model, 'predict_quantiles'):
+        quantiles = member.model.predict_quantiles(X)
+    return member.model.predict(X), quantiles
+
+
+def _item(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+model_registry = ModelRegistry()
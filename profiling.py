@@ -0,0 +1,162 @@
+# Opt-in profiling for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Captures cProfile output and SQL query counts and timings for a single
+# command-line job or web request and writes a report to disk. Profiling is
+# enabled with the ZOOPREDICT_PROFILE environment variable or the --profile
+# flag of the command-line tools; when it is not enabled nothing is hooked in.
+
+import contextlib
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# number of functions and statements to include in the text reports
+REPORT_LIMIT = 40
+
+
+class SQLQueryRecorder(object):
+    """
+    Records the number and duration of SQL statements executed by the current
+    thread through any SQLAlchemy engine.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self._thread_id = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread().ident == self._thread_id:
+            conn.info.setdefault('profiling_query_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread().ident != self._thread_id:
+            return
+        start_times = conn.info.get('profiling_query_start_time')
+        if not start_times:
+            return
+        elapsed = time.time() - start_times.pop()
+        count, total = self.queries.get(statement, (0, 0.0))
+        self.queries[statement] = (count + 1, total + elapsed)
+
+    def start(self):
+        self._thread_id = threading.current_thread().ident
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def stop(self):
+        event.remove(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @property
+    def query_count(self):
+        return sum(count for count, _ in self.queries.values())
+
+    @property
+    def query_time(self):
+        return sum(total for _, total in self.queries.values())
+
+    def report(self, limit=REPORT_LIMIT):
+        lines = ["SQL queries: {n}, total time {t:.4f} s".format(n=self.query_count, t=self.query_time)]
+        by_time = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+        for statement, (count, total) in by_time[:limit]:
+            lines.append("")
+            lines.append("{c:6d} calls  {t:.4f} s".format(c=count, t=total))
+            lines.append("    " + " ".join(statement.split()))
+        return "\n".join(lines)
+
+
+class Profiler(object):
+    """
+    Profiles the Python code and SQL queries run by the current thread between
+    start() and stop() and writes a report into the output directory.
+    """
+
+    def __init__(self, name, output_dir):
+        self.name = name
+        self.output_dir = output_dir
+        self._profile = cProfile.Profile()
+        self._sql = SQLQueryRecorder()
+        self._start_time = None
+        self._elapsed = None
+
+    def start(self):
+        self._sql.start()
+        self._start_time = time.time()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._elapsed = time.time() - self._start_time
+        self._sql.stop()
+
+    def write_report(self):
+        """
+        Writes the raw cProfile data (readable with pstats or e.g. snakeviz) and
+        a text summary into the output directory.
+        :return: the path of the text report
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        base_path = os.path.join(self.output_dir, "{n}-{t}".format(n=self.name, t=timestamp))
+
+        self._profile.dump_stats(base_path + ".prof")
+
+        stats_output = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stats_output)
+        stats.sort_stats('cumulative').print_stats(REPORT_LIMIT)
+
+        report_path = base_path + ".txt"
+        with open(report_path, 'w') as f:
+            f.write("Profile of {n}, wall clock time {t:.4f} s\n\n".format(n=self.name, t=self._elapsed))
+            f.write(self._sql.report())
+            f.write("\n\n")
+            f.write(stats_output.getvalue())
+
+        logger.info("Wrote profiling report into {p}".format(p=report_path))
+        return report_path
+
+
+def is_true(value):
+    """
+    Parses a flag given as a string, e.g. in an environment variable or a query parameter.
+    """
+    return (value or '').strip().lower() in ('1', 'true', 'yes')
+
+
+def is_enabled_by_environment():
+    return is_true(os.environ.get('ZOOPREDICT_PROFILE'))
+
+
+@contextlib.contextmanager
+def profiled(name, output_dir, enabled=True):
+    """
+    Context manager that profiles its body if enabled. When not enabled, it
+    does nothing at all.
+    :param name: name of the profiled job, used in the report file names
+    :param output_dir: directory into which the reports are written
+    :param enabled: whether to profile
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = Profiler(name, output_dir)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.write_report()
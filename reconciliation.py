@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Forecast/observation reconciliation for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Compares the weather forecasts the predictions were made with to the weather
+# that was later observed, so that prediction errors caused by the forecast
+# can be told apart from errors of the model itself. The comparison is done in
+# the database with a single INSERT ... SELECT that only covers dates not
+# reconciled yet. Optionally the visitor predictions are re-scored with the
+# observed weather, in one batch for all dates.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import logging.config
+
+from sqlalchemy import and_, func
+
+import appfactory
+import config
+import metrics
+import models
+import predictor
+
+logger = logging.getLogger(__name__)
+
+WEATHER_VARIABLES = ['temp_max', 'temp_min', 'temp_mean', 'precipitation']
+
+
+def _latest_per_date(model):
+    """
+    Returns a subquery of the latest (highest id) row of the given daily
+    weather model for each date; the harvesters may store several per day.
+    """
+    return models.db.session.query(func.max(model.id).label('id')).group_by(model.date).subquery()
+
+
+def reconcile_forecasts():
+    """
+    Stores the forecast errors for all dates that have both a forecast and an
+    observation but have not been reconciled yet. Must be called within an app context.
+    :return: the number of dates reconciled
+    """
+    session = models.db.session
+    forecast = models.WeatherForecast
+    observation = models.WeatherObservation
+    error = models.ForecastError
+
+    latest_forecasts = _latest_per_date(forecast)
+    latest_observations = _latest_per_date(observation)
+    already_reconciled = session.query(error.date)
+
+    columns = [forecast.date, forecast.id, observation.id] + \
+              [getattr(forecast, v) - getattr(observation, v) for v in WEATHER_VARIABLES]
+    select = session.query(*columns)\
+                    .join(latest_forecasts, latest_forecasts.c.id == forecast.id)\
+                    .join(observation, observation.date == forecast.date)\
+                    .join(latest_observations, latest_observations.c.id == observation.id)\
+                    .filter(~forecast.date.in_(already_reconciled.statement))
+
+    target_columns = ['date', 'forecast_id', 'observation_id'] + [v + '_error' for v in WEATHER_VARIABLES]
+    insert = error.__table__.insert().from_select(target_columns, select.statement)
+
+    with metrics.histogram("reconciliation_seconds", "Duration of reconciliation steps").time(step='forecasts'):
+        result = session.execute(insert)
+        session.commit()
+
+    logger.info("Reconciled forecasts for {n} new dates".format(n=result.rowcount))
+    return result.rowcount
+
+
+def rescore_predictions(registry, rescore_all=False):
+    """
+    Predicts visitors for reconciled dates using the observed weather, for all
+    dates in one batch, and stores the results. Must be called within an app context.
+    :param registry: a loaded predictor.ModelRegistry
+    :param rescore_all: also re-score dates already scored, e.g. after retraining
+    :return: the number of dates re-scored
+    """
+    session = models.db.session
+    error = models.ForecastError
+    observation = models.WeatherObservation
+
+    query = session.query(error.id, observation.date, observation.temp_max, observation.precipitation)\
+                   .join(observation, observation.id == error.observation_id)\
+                   .filter(and_(observation.temp_max.isnot(None), observation.precipitation.isnot(None)))
+    if not rescore_all:
+        query = query.filter(error.rescored_visitors.is_(None))
+    rows = query.all()
+    if not rows:
+        return 0
+
+    with metrics.histogram("reconciliation_seconds", "Duration of reconciliation steps").time(step='rescore'):
+        # negative precipitation values mean "no precipitation" in the FMI data; see ModelBuilder
+        classes, visitors, _, members = registry.predict_features_with_members(
+            [row.temp_max for row in rows], [max(row.precipitation, 0.0) for row in rows],
+            [row.date.weekday() for row in rows])
+
+        # the model ids are None for an ensemble, so its members are stored like the harvester does
+        updates = [{'id': row.id,
+                    'rescored_visitors': int(round(v)),
+                    'rescored_visitors_class': c,
+                    'rescored_classifier_id': registry.classifier_id,
+                    'rescored_regression_model_id': registry.regression_model_id}
+                   for row, c, v in zip(rows, classes, visitors)]
+        member_rows = [dict(predictor.member_columns(member), forecast_error_id=row.id)
+                       for row, row_members in zip(rows, members) for member in row_members]
+
+        session.bulk_update_mappings(error, updates)
+        session.query(models.ForecastErrorMember)\
+               .filter(models.ForecastErrorMember.forecast_error_id.in_([row.id for row in rows]))\
+               .delete(synchronize_session=False)
+        session.bulk_insert_mappings(models.ForecastErrorMember, member_rows)
+        session.commit()
+
+    logger.info("Re-scored predictions for {n} dates".format(n=len(updates)))
+    return len(updates)
+
+
+def forecast_error_summary():
+    """
+    Computes summary statistics of the stored forecast errors in the database.
+    Must be called within an app context.
+    :return: a dict with the number of days and the mean and mean absolute error of each weather variable
+    """
+    error = models.ForecastError
+    columns = [func.count(error.id)]
+    for v in WEATHER_VARIABLES:
+        column = getattr(error, v + '_error')
+        columns.extend([func.avg(column), func.avg(func.abs(column))])
+    row = models.db.session.query(*columns).one()
+
+    summary = {'days': row[0]}
+    for i, v in enumerate(WEATHER_VARIABLES):
+        summary[v] = {'mean_error': row[1 + 2 * i], 'mean_absolute_error': row[2 + 2 * i]}
+    return summary
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rescore', dest='rescore', action='store_true', default=False,
+                        help='re-score the predictions of newly reconciled dates with the observed weather')
+    parser.add_argument('-a', '--rescore-all', dest='rescore_all', action='store_true', default=False,
+                        help='re-score the predictions of all reconciled dates with the current models')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    app = appfactory.create_app(__name__)
+
+    with app.app_context():
+        reconcile_forecasts()
+
+        if args.rescore or args.rescore_all:
+            registry = predictor.ModelRegistry()
+            registry.load()
+            rescore_predictions(registry, args.rescore_all)
+
+        summary = forecast_error_summary()
+
+    print("Reconciled days: {n}".format(n=summary['days']))
+    for v in WEATHER_VARIABLES:
+        print("{v}: mean error {m}, mean absolute error {a}".format(v=v, m=summary[v]['mean_error'],
+                                                                    a=summary[v]['mean_absolute_error']))
+
+    metrics.dump_json_if_configured(app.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# Data retention for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Keeps the weather_forecast and zoo_statistic_prediction tables bounded:
+#
+#  1. forecasts and predictions superseded by a later harvester run for the
+#     same date are deleted,
+#  2. daily rows from months older than RETENTION_DAYS are rolled up into the
+#     monthly aggregate tables and deleted, one month per transaction, so
+#     that a failed run never leaves rows both aggregated and kept. Rows that
+#     arrive late for a month already rolled up are merged into its aggregate.
+#
+# Superseded rows are deleted in batches of RETENTION_BATCH_SIZE rows so that
+# no single transaction locks the tables for long. With --dry-run only the
+# numbers of affected rows are reported.
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import logging
+import logging.config
+import time
+
+from sqlalchemy import and_, case, cast, func
+
+import appfactory
+import config
+import metrics
+import models
+
+logger = logging.getLogger(__name__)
+
+
+def retention_cutoff(today, retention_days):
+    """
+    Returns the first date that is kept as daily rows. The cutoff is aligned to
+    the start of a month so that the rows of a month are rolled up together.
+    """
+    oldest_kept = today - datetime.timedelta(days=retention_days)
+    return oldest_kept.replace(day=1)
+
+
+def _latest_ids(model):
+    """
+    Returns a query for the ids of the latest row (highest id) of each date.
+    """
+    return models.db.session.query(func.max(model.id)).group_by(model.date)
+
+
+def _superseded(model):
+    """
+    Returns a filter condition matching rows for which a later row (higher id)
+    exists for the same date.
+    """
+    return ~model.id.in_(_latest_ids(model).statement)
+
+
+def _delete_rows(model, ids, dependents=()):
+    """
+    Deletes the rows of the given ids, together with the rows of dependent
+    tables referring to them. Does not commit.
+    :param dependents: list of foreign key columns referring to model.id
+    :return: the number of rows deleted
+    """
+    session = models.db.session
+    for foreign_key in dependents:
+        session.query(foreign_key.class_).filter(foreign_key.in_(ids)).delete(synchronize_session=False)
+    session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+
+def _delete_in_batches(model, condition, batch_size, dependents=(), versioned=False):
+    """
+    Deletes the rows matching the condition in batches, together with the rows
+    of dependent tables referring to them.
+    :param dependents: list of foreign key columns referring to model.id
+    :param versioned: bump the data version in every transaction, for rows shown in the web UI
+    """
+    session = models.db.session
+    deleted = 0
+    while True:
+        ids = [row[0] for row in session.query(model.id).filter(condition).limit(batch_size)]
+        if not ids:
+            return deleted
+        deleted += _delete_rows(model, ids, dependents)
+        if versioned:
+            models.bump_data_version()
+        session.commit()
+
+
+def _roll_up_months(model, roll_up_func, cutoff, dependents=(), versioned=False):
+    """
+    Rolls up the daily rows before the cutoff month by month: the rows of a
+    month are aggregated into its monthly row and deleted in one transaction.
+    :param roll_up_func: function taking a filter condition that aggregates the matching rows
+    :param dependents: list of foreign key columns referring to model.id
+    :param versioned: bump the data version in every transaction, for rows shown in the web UI
+    :return: the number of daily rows rolled up
+    """
+    session = models.db.session
+    year, month = _year_month(model.date)
+    months = session.query(year, month).filter(model.date < cutoff).distinct().order_by(year, month).all()
+
+    rolled = 0
+    for y, m in months:
+        first = datetime.date(y, m, 1)
+        following = datetime.date(y + m // 12, m % 12 + 1, 1)
+        ids = [row[0] for row in session.query(model.id).filter(model.date >= first, model.date < following)]
+        try:
+            roll_up_func(model.id.in_(ids))
+            rolled += _delete_rows(model, ids, dependents)
+            if versioned:
+                models.bump_data_version()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+    return rolled
+
+
+def _year_month(date_column):
+    return cast(func.extract('year', date_column), models.db.Integer), \
+           cast(func.extract('month', date_column), models.db.Integer)
+
+
+def _add(a, b):
+    """
+    Adds two sums either of which may be NULL.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _weighted_mean(mean_a, weight_a, mean_b, weight_b):
+    """
+    Combines two means either of which may be NULL.
+    """
+    if mean_a is None:
+        return mean_b
+    if mean_b is None:
+        return mean_a
+    return (mean_a * weight_a + mean_b * weight_b) / float(weight_a + weight_b)
+
+
+def _store_monthly(monthly_model, rows, columns, merge):
+    """
+    Stores monthly aggregates. A month that has been rolled up before, i.e.
+    whose daily rows arrived late, is merged into its existing aggregate.
+    :param rows: (year, month, value...) tuples
+    :param columns: the names of the value columns
+    :param merge: function (existing aggregate, dict of new values) returning the merged values as a dict
+    :return: the number of months stored
+    """
+    session = models.db.session
+    for row in rows:
+        year, month = row[:2]
+        values = dict(zip(columns, row[2:]))
+        existing = monthly_model.query.filter_by(year=year, month=month).first()
+        if existing is None:
+            session.add(monthly_model(year=year, month=month, **values))
+        else:
+            for column, value in merge(existing, values).items():
+                setattr(existing, column, value)
+    return len(rows)
+
+
+def _roll_up_forecasts(condition):
+    session = models.db.session
+    forecast = models.WeatherForecast
+    year, month = _year_month(forecast.date)
+
+    rows = session.query(year, month, func.count(forecast.id),
+                         func.avg(forecast.temp_max), func.avg(forecast.temp_min),
+                         func.avg(forecast.temp_mean), func.sum(forecast.precipitation))\
+                  .filter(condition)\
+                  .group_by(year, month).all()
+
+    def merge(existing, new):
+        merged = {c: _weighted_mean(getattr(existing, c), existing.days, new[c], new['days'])
+                  for c in ['temp_max', 'temp_min', 'temp_mean']}
+        merged['days'] = existing.days + new['days']
+        merged['precipitation'] = _add(existing.precipitation, new['precipitation'])
+        return merged
+
+    return _store_monthly(models.WeatherForecastMonthly, rows,
+                          ['days', 'temp_max', 'temp_min', 'temp_mean', 'precipitation'], merge)
+
+
+def _roll_up_predictions(condition):
+    session = models.db.session
+    prediction = models.ZooStatisticPrediction
+    actual = models.ZooStatisticActual
+    year, month = _year_month(prediction.date)
+
+    # only the latest actual value of a date is compared, so that duplicate
+    # actual rows are not counted twice
+    error = prediction.visitors - actual.visitors
+    rows = session.query(year, month, func.count(prediction.id), func.sum(prediction.visitors),
+                         func.count(actual.id), func.sum(func.abs(error)), func.sum(error * error),
+                         func.sum(case([(prediction.visitors_class == actual.visitors_class, 1)], else_=0)))\
+                  .outerjoin(actual, and_(actual.date == prediction.date,
+                                          actual.id.in_(_latest_ids(actual).statement)))\
+                  .filter(condition)\
+                  .group_by(year, month).all()
+
+    def merge(existing, new):
+        return {c: _add(getattr(existing, c), value) for c, value in new.items()}
+
+    return _store_monthly(models.ZooStatisticPredictionMonthly, rows,
+                          ['days', 'visitors_sum', 'days_with_actual', 'absolute_error_sum', 'squared_error_sum',
+                           'class_hits'], merge)
+
+
+def run_retention(today, retention_days, batch_size, dry_run=False):
+    """
+    Runs all retention steps. Must be called within an app context.
+    :param today: the current date
+    :param retention_days: how many days of daily rows to keep at least
+    :param batch_size: the maximum number of superseded rows deleted in one transaction
+    :param dry_run: only count the rows that would be affected
+    :return: a list of (step, affected rows, seconds) tuples
+    """
+    session = models.db.session
+    forecast = models.WeatherForecast
+    prediction = models.ZooStatisticPrediction
+    # ensemble member predictions are deleted with their predictions
+    prediction_dependents = [models.ZooStatisticPredictionMember.prediction_id]
+    cutoff = retention_cutoff(today, retention_days)
+    logger.info("Rolling up daily rows before {c}".format(c=cutoff))
+
+    report = []
+
+    def step(name, count_query, action):
+        start = time.time()
+        if dry_run:
+            affected = count_query.count()
+        else:
+            with metrics.histogram("retention_seconds", "Duration of retention steps").time(step=name):
+                affected = action()
+            metrics.counter("retention_rows_total", "Rows affected by retention steps").inc(affected, step=name)
+        report.append((name, affected, time.time() - start))
+
+    step('delete_superseded_forecasts',
+         session.query(forecast.id).filter(_superseded(forecast)),
+         lambda: _delete_in_batches(forecast, _superseded(forecast), batch_size))
+    step('delete_superseded_predictions',
+         session.query(prediction.id).filter(_superseded(prediction)),
+         lambda: _delete_in_batches(prediction, _superseded(prediction), batch_size, prediction_dependents,
+                                    versioned=True))
+
+    step('roll_up_forecasts',
+         session.query(forecast.id).filter(forecast.date < cutoff),
+         lambda: _roll_up_months(forecast, _roll_up_forecasts, cutoff))
+    step('roll_up_predictions',
+         session.query(prediction.id).filter(prediction.date < cutoff),
+         lambda: _roll_up_months(prediction, _roll_up_predictions, cutoff, prediction_dependents, versioned=True))
+
+    return report
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='only report the number of rows that would be affected')
+    parser.add_argument('-r', '--retention-days', dest='retention_days', type=int, default=None,
+                        help='keep daily rows for at least this many days (default: RETENTION_DAYS)')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    app = appfactory.create_app(__name__)
+    retention_days = args.retention_days if args.retention_days is not None else app.config['RETENTION_DAYS']
+
+    with app.app_context():
+        report = run_retention(datetime.date.today(), retention_days, app.config['RETENTION_BATCH_SIZE'],
+                               dry_run=args.dry_run)
+
+    print("Dry run; nothing was changed." if args.dry_run else "Retention run finished.")
+    for name, affected, seconds in report:
+        print("{n:32s} {a:8d} rows  {s:8.3f} s".format(n=name, a=affected, s=seconds))
+
+    metrics.dump_json_if_configured(app.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# In-process job scheduler for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Runs the daily pipeline (harvesters, reconciliation, retention) and the
+# periodic retraining in one long-running process instead of separate
+# cron-started scripts, so that the Flask app, the database connection pool
+# and the prediction models are set up once and stay warm between runs.
+# The schedules are configured in config.SCHEDULER_JOBS. A lock stored in the
+# database (job_lock) keeps the same job from running in two scheduler
+# processes at once, and every run is recorded in the job_run table.
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import logging
+import logging.config
+import os
+import random
+import socket
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+import appfactory
+import config
+import fmi_harvester
+import metrics
+import models
+import predictor
+import reconciliation
+import retention
+import train
+import zoodatafetcher
+
+logger = logging.getLogger(__name__)
+
+# the known jobs by name; each is a function taking the Flask app
+JOBS = collections.OrderedDict()
+
+
+def job(name):
+    """
+    Registers the decorated function as the scheduled job of the given name.
+    """
+    def register(func):
+        JOBS[name] = func
+        return func
+    return register
+
+
+@job('fmi_harvester')
+def _run_fmi_harvester(app):
+    fmi_harvester.FMIHarvester(app).harvest()
+
+
+@job('zoodatafetcher')
+def _run_zoodatafetcher(app):
+    zoodatafetcher.zoodatafetcher(app)
+
+
+@job('reconciliation')
+def _run_reconciliation(app):
+    with app.app_context():
+        reconciliation.reconcile_forecasts()
+        registry = predictor.model_registry
+        try:
+            registry.refresh_if_stale(app.config['MODEL_REFRESH_INTERVAL'])
+        except LookupError:
+            logger.warning("No trained models in the database; not re-scoring predictions")
+            return
+        reconciliation.rescore_predictions(registry)
+
+
+@job('retention')
+def _run_retention(app):
+    with app.app_context():
+        retention.run_retention(datetime.date.today(), app.config['RETENTION_DAYS'],
+                                app.config['RETENTION_BATCH_SIZE'])
+
+
+@job('train')
+def _run_train(app):
+    train.train_from_database(app, keep_existing=app.config['SCHEDULER_TRAIN_KEEP_EXISTING'])
+    with app.app_context():
+        predictor.model_registry.load()
+
+
+def acquire_lock(name, owner, timeout, now=None):
+    """
+    Tries to take the lock of the given job. Must be called within an app context.
+    :param name: the job name
+    :param owner: identifies the process taking the lock
+    :param timeout: the number of seconds after which the lock expires if not released
+    :param now: the current time
+    :return: True if the lock was taken, False if another owner holds it
+    """
+    session = models.db.session
+    lock = models.JobLock
+    now = now or datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=timeout)
+
+    # take over an expired lock; a single UPDATE so that only one process can win
+    taken = session.query(lock).filter(lock.name == name, lock.expires_at < now)\
+                   .update({lock.owner: owner, lock.acquired_at: now, lock.expires_at: expires_at},
+                           synchronize_session=False)
+    if taken:
+        session.commit()
+        return True
+
+    # or create the lock; the primary key makes this fail if someone holds it
+    try:
+        session.add(lock(name=name, owner=owner, acquired_at=now, expires_at=expires_at))
+        session.commit()
+        return True
+    except IntegrityError:
+        session.rollback()
+        return False
+
+
+def release_lock(name, owner):
+    """
+    Releases the lock of the given job if held by the given owner. Must be called within an app context.
+    """
+    session = models.db.session
+    lock = models.JobLock
+    session.query(lock).filter(lock.name == name, lock.owner == owner).delete(synchronize_session=False)
+    session.commit()
+
+
+class Scheduler(object):
+    """
+    Runs the configured jobs when they are due, one at a time.
+    """
+
+    def __init__(self, app, schedules, jobs=JOBS, owner=None, lock_timeout=config.SCHEDULER_LOCK_TIMEOUT):
+        """
+        :param app: the Flask app the jobs run with
+        :param schedules: the job schedules, a dict like config.SCHEDULER_JOBS
+        :param jobs: the job functions by name
+        :param owner: identifies this process in the job locks; defaults to host name and process id
+        :param lock_timeout: the number of seconds after which a job lock expires
+        """
+        unknown = set(schedules) - set(jobs)
+        if unknown:
+            raise ValueError("Unknown jobs in schedule: {j}".format(j=", ".join(sorted(unknown))))
+
+        self._app = app
+        self._schedules = {name: schedule for name, schedule in schedules.items() if schedule.get('enabled', True)}
+        self._jobs = jobs
+        self._lock_timeout = lock_timeout
+        self._random = random.Random()
+        self._next_runs = {}
+        self.owner = owner or "{h}:{p}".format(h=socket.gethostname(), p=os.getpid())
+
+    @property
+    def job_names(self):
+        return sorted(self._schedules)
+
+    def next_run_time(self, name, last_started, now):
+        """
+        Computes when a job is due next, including a random jitter.
+        :param name: the job name
+        :param last_started: when the job was last started, or None if it has never run
+        :param now: the current time
+        :return: the time of the next run; may be in the past if a run was missed
+        """
+        schedule = self._schedules[name]
+        if 'daily_at' in schedule:
+            hour, minute = [int(part) for part in schedule['daily_at'].split(':')]
+            after = last_started or now
+            due = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if due <= after:
+                due += datetime.timedelta(days=1)
+        elif last_started is not None:
+            due = last_started + datetime.timedelta(seconds=schedule['interval'])
+        else:
+            due = now
+        return due + datetime.timedelta(seconds=self._random.uniform(0, schedule.get('jitter', 0)))
+
+    def last_started(self, name):
+        """
+        Returns when the given job was last started by any scheduler process, or None.
+        """
+        with self._app.app_context():
+            return models.db.session.query(func.max(models.JobRun.started_at))\
+                                    .filter(models.JobRun.job == name).scalar()
+
+    def run_pending(self, now=None):
+        """
+        Runs all jobs that are due.
+        :param now: the current time
+        :return: the names of the jobs run
+        """
+        now = now or datetime.datetime.now()
+        ran = []
+        for name in self.job_names:
+            if name not in self._next_runs:
+                self._next_runs[name] = self.next_run_time(name, self.last_started(name), now)
+                logger.info("Job {j} is due at {t}".format(j=name, t=self._next_runs[name]))
+            if self._next_runs[name] <= now:
+                if self.run_job(name):
+                    ran.append(name)
+                # the next run is computed from the job_run table, which also
+                # covers runs made by other scheduler processes
+                del self._next_runs[name]
+        return ran
+
+    def run_job(self, name):
+        """
+        Runs a job now unless another process is running it, and records the run.
+        :param name: the job name
+        :return: True if the job was run (successfully or not), False if it was locked
+        """
+        with self._app.app_context():
+            if not acquire_lock(name, self.owner, self._lock_timeout):
+                logger.info("Job {j} is running in another process; skipping".format(j=name))
+                metrics.counter("scheduler_skipped_runs_total", "Scheduled job runs skipped because of a lock")\
+                       .inc(job=name)
+                return False
+            run = models.JobRun(name, self.owner, datetime.datetime.now())
+            models.db.session.add(run)
+            models.db.session.commit()
+            run_id = run.id
+
+        logger.info("Running job {j}".format(j=name))
+        start = time.time()
+        error = None
+        try:
+            self._jobs[name](self._app)
+        except Exception as e:
+            logger.exception("Job {j} failed".format(j=name))
+            error = "{t}: {e}".format(t=type(e).__name__, e=e)[:1000]
+        seconds = time.time() - start
+
+        with self._app.app_context():
+            models.db.session.query(models.JobRun).filter(models.JobRun.id == run_id)\
+                  .update({models.JobRun.finished_at: datetime.datetime.now(), models.JobRun.seconds: seconds,
+                           models.JobRun.succeeded: error is None, models.JobRun.error: error},
+                          synchronize_session=False)
+            models.db.session.commit()
+            release_lock(name, self.owner)
+
+        status = 'succeeded' if error is None else 'failed'
+        logger.info("Job {j} {s} in {t:.3f} s".format(j=name, s=status, t=seconds))
+        metrics.histogram("scheduler_job_seconds", "Duration of scheduled job runs").observe(seconds, job=name)
+        metrics.counter("scheduler_job_runs_total", "Scheduled job runs").inc(job=name, status=status)
+        metrics.dump_json_if_configured(self._app.config)
+        return True
+
+    def run_forever(self, poll_interval):
+        logger.info("Scheduler {o} running jobs: {j}".format(o=self.owner, j=", ".join(self.job_names)))
+        while True:
+            self.run_pending()
+            time.sleep(poll_interval)
+
+
+def _warm_up(app):
+    """
+    Loads the prediction models once at startup so that the first jobs do not pay for it.
+    """
+    with app.app_context():
+        try:
+            predictor.model_registry.load()
+        except LookupError:
+            logger.warning("No trained models in the database yet")
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', dest='run', action='append', choices=list(JOBS), default=[],
+                        help='run the given job now and exit; may be repeated')
+    parser.add_argument('-l', '--list', dest='list', action='store_true', default=False,
+                        help='list the scheduled jobs and when they are due next, and exit')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    app = appfactory.create_app(__name__)
+    scheduler = Scheduler(app, app.config['SCHEDULER_JOBS'], lock_timeout=app.config['SCHEDULER_LOCK_TIMEOUT'])
+
+    if args.list:
+        now = datetime.datetime.now()
+        for name in scheduler.job_names:
+            print("{j:16s} {t}".format(j=name, t=scheduler.next_run_time(name, scheduler.last_started(name), now)))
+        return
+
+    _warm_up(app)
+
+    if args.run:
+        for name in args.run:
+            scheduler.run_job(name)
+        return
+
+    scheduler.run_forever(app.config['SCHEDULER_POLL_INTERVAL'])
+
+if __name__ == "__main__":
+    main()
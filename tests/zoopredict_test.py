@@ -2,19 +2,41 @@
 
 from __future__ import print_function
 
+import datetime
+import os
+import shutil
+import tempfile
 import unittest
 from nose.tools import assert_almost_equals
 from nose.tools import assert_is_not_none
 from nose.tools import assert_equals
+from nose.tools import assert_false
 from nose.tools import assert_in
 from nose.tools import assert_not_in
+from nose.tools import assert_raises
+from nose.tools import assert_true
 from nose.tools import raises
+import numpy as np
 import pandas as pd
 
+import appfactory
+import backtest
+import cache
+import checkpoints
+import dataset
 import fmi_parser
 import initdb
+import metrics
 import models
+import prediction_models
+import predictor
+import profiling
+import reconciliation
+import retention
+import scheduler
 import train
+import visitor_classes
+import zoodatafetcher
 import zoopredict_web
 
 
@@ -60,3 +82,504 @@ class ZooPredictTest(unittest.TestCase):
             assert_is_not_none(classifier)
             assert_is_not_none(regression_model)
 
+
+    def test_file_sqlite_database(self):
+        directory = tempfile.mkdtemp()
+        try:
+            app = appfactory.create_app(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(directory, "test.db")
+            with app.app_context():
+                models.db.create_all()
+                models.db.session.add(models.ZooStatisticActual(datetime.date(2015, 1, 1), 120, 1))
+                models.db.session.commit()
+                assert_equals(models.ZooStatisticActual.query.count(), 1)
+                models.db.session.remove()
+                models.db.get_engine(app).dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_profiling_flag(self):
+        assert_true(profiling.is_true('1'))
+        assert_true(profiling.is_true('True'))
+        assert_false(profiling.is_true('0'))
+        assert_false(profiling.is_true('false'))
+        assert_false(profiling.is_true(None))
+
+    def test_metrics(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter("test_events_total", "Test events").inc(3, kind='a')
+        registry.histogram("test_duration_seconds", buckets=(0.1, 1.0)).observe(0.5)
+
+        output = registry.render_prometheus()
+        assert_in('test_events_total{kind="a"} 3.0', output)
+        assert_in('test_duration_seconds_bucket{le="0.1"} 0.0', output)
+        assert_in('test_duration_seconds_bucket{le="1.0"} 1.0', output)
+        assert_in('test_duration_seconds_count 1.0', output)
+
+        client = zoopredict_web.app.test_client()
+        response = client.get('/metrics')
+        assert_equals(response.status_code, 200)
+
+    def test_predict_rejects_invalid_weather(self):
+        client = zoopredict_web.app.test_client()
+        for query in ['temp_max=nan', 'temp_max=inf', 'temp_max=2.5&precipitation=-inf', 'temp_max=warm', '']:
+            response = client.get('/api/predict?date=2017-03-01&' + query)
+            assert_equals(response.status_code, 400)
+
+    def test_ttl_cache(self):
+        lru = cache.TTLCache(max_size=2, ttl=60, metric_prefix='test_cache')
+        lru.put('a', 1)
+        lru.put('b', 2)
+        assert_equals(lru.get('a'), 1)
+
+        # 'b' is now the least recently used entry and gets evicted
+        lru.put('c', 3)
+        assert_equals(lru.get('b'), None)
+        assert_equals(lru.get('c'), 3)
+        assert_equals(len(lru), 2)
+        assert_almost_equals(lru.hit_rate, 2.0 / 3)
+
+        expired = cache.TTLCache(max_size=2, ttl=-1, metric_prefix='test_cache')
+        expired.put('a', 1)
+        assert_equals(expired.get('a'), None)
+
+    def test_quantile_regression_model(self):
+        weather_data = pd.read_csv('data/weather_observations.csv')
+        visitor_data = pd.read_csv('data/oldVisitorCounts.csv')
+        builder = train.ModelBuilder(zoopredict_web.app, weather_data, visitor_data)
+        model, scores = builder.build_quantile_regression_model(quantiles=[0.1, 0.5, 0.9], cv=2)
+
+        X = builder.data[train.DEFAULT_PREDICTORS].as_matrix()[:10]
+        quantiles = model.predict_quantiles(X)
+        assert_equals(quantiles.shape, (10, 3))
+        assert_true(np.all(np.diff(quantiles, axis=1) >= 0))
+        assert_equals(model.name, 'LinearRegression')
+
+        # the median is required
+        with assert_raises(ValueError):
+            builder.build_quantile_regression_model(quantiles=[0.1, 0.9], cv=2)
+
+    def test_prediction_quantiles(self):
+        prediction = models.ZooStatisticPrediction(datetime.date(2017, 3, 1), 200, 1)
+        prediction.set_quantiles([100.4, 150.0, 210.0, 300.6], [0.05, 0.25, 0.5, 0.95])
+        assert_equals((prediction.visitors_low, prediction.visitors_median, prediction.visitors_high),
+                      (100, 210, 301))
+
+    def test_prediction_quantiles_without_median(self):
+        prediction = models.ZooStatisticPrediction(datetime.date(2017, 3, 1), 200, 1)
+        prediction.set_quantiles([100.0, 300.0], [0.1, 0.9])
+        assert_equals((prediction.visitors_low, prediction.visitors_median, prediction.visitors_high),
+                      (100, None, 300))
+
+    def test_dataset_store(self):
+        store_path = tempfile.mkdtemp()
+        try:
+            store = dataset.DatasetStore(store_path)
+            dataset.import_csv(store, 'data/oldVisitorCounts.csv', 'data/weather_observations.csv')
+            assert_equals(store.partitions('weather')[0], 2010)
+
+            weather_data, visitor_data = dataset.load_training_data(store, '2010-01-02', '2010-01-03')
+            assert_equals(len(weather_data), 2)
+            assert_equals(list(visitor_data['visitors']), [148, 156])
+            assert_equals(list(visitor_data['weekday']), ['Sat', 'Sun'])
+
+            builder = train.ModelBuilder(zoopredict_web.app, *dataset.load_training_data(store))
+            assert_equals(len(builder.data), len(pd.read_csv('data/weather_observations.csv')))
+        finally:
+            shutil.rmtree(store_path)
+
+    def test_training_data_from_database(self):
+        app = zoopredict_web.app
+        class_table = visitor_classes.for_app(app)
+        start, end = datetime.date(2011, 2, 1), datetime.date(2011, 2, 6)
+        with app.app_context():
+            for day in range(1, 6):
+                date = datetime.date(2011, 2, day)
+                models.db.session.add(models.WeatherObservation(date, temp_max=float(day), precipitation=0.5))
+                models.db.session.add(models.ZooStatisticActual(date, 100 * day, class_table.classify(100 * day)))
+            # a day with weather but no actual visitor count is not training data
+            models.db.session.add(models.WeatherObservation(end, temp_max=6.0, precipitation=0.5))
+            models.db.session.commit()
+
+        try:
+            weather_data, visitor_data = dataset.load_training_data_from_database(
+                app, datetime.date(2011, 2, 2), end, chunk_size=2)
+            assert_equals(list(weather_data['temp_max']), [2.0, 3.0, 4.0, 5.0])
+            assert_equals(list(visitor_data['visitors']), [200, 300, 400, 500])
+            assert_equals(list(visitor_data['weekday']), ['Wed', 'Thu', 'Fri', 'Sat'])
+        finally:
+            with app.app_context():
+                for model in [models.WeatherObservation, models.ZooStatisticActual]:
+                    model.query.filter(model.date.between(start, end)).delete(synchronize_session=False)
+                models.db.session.commit()
+
+    def test_reconciliation(self):
+        date = datetime.date(2012, 1, 15)
+        with zoopredict_web.app.app_context():
+            models.db.session.add(models.WeatherForecast(date, temp_max=1.0, temp_min=-3.0,
+                                                         temp_mean=-1.0, precipitation=0.0))
+            models.db.session.add(models.WeatherForecast(date, temp_max=2.0, temp_min=-2.0,
+                                                         temp_mean=0.0, precipitation=1.0))
+            models.db.session.add(models.WeatherObservation(date, temp_max=0.5, temp_min=-2.5,
+                                                            temp_mean=-1.0, precipitation=1.5))
+            models.db.session.commit()
+
+            assert_equals(reconciliation.reconcile_forecasts(), 1)
+            assert_equals(reconciliation.reconcile_forecasts(), 0)
+
+            # the latest forecast of the day is the one compared
+            error = models.ForecastError.query.filter_by(date=date).one()
+            assert_almost_equals(error.temp_max_error, 1.5)
+            assert_almost_equals(error.precipitation_error, -0.5)
+
+    def test_rescore_with_ensemble(self):
+        class ConstantModel(object):
+            def __init__(self, value):
+                self.value = value
+
+            def predict(self, X):
+                return np.full(len(X), self.value)
+
+        registry = predictor.ModelRegistry(workers=1)
+        registry.classifiers = [predictor.LoadedModel(11, 'first', ConstantModel(1), 1.0),
+                                predictor.LoadedModel(12, 'second', ConstantModel(1), 1.0)]
+        registry.regression_models = [predictor.LoadedModel(21, 'regression', ConstantModel(150.0), 1.0)]
+        registry.version = ('rescore test',)
+
+        date = datetime.date(2012, 2, 15)
+        with zoopredict_web.app.app_context():
+            models.db.session.add(models.WeatherForecast(date, temp_max=1.0, precipitation=0.0))
+            models.db.session.add(models.WeatherObservation(date, temp_max=2.0, precipitation=0.5))
+            models.db.session.commit()
+            reconciliation.reconcile_forecasts()
+
+            for rescore_all in [False, True]:
+                reconciliation.rescore_predictions(registry, rescore_all=rescore_all)
+                error = models.ForecastError.query.filter_by(date=date).one()
+                assert_equals(error.rescored_visitors, 150)
+                # the classifiers form an ensemble, so their ids are only stored with the members
+                assert_equals(error.rescored_classifier_id, None)
+                assert_equals(error.rescored_regression_model_id, 21)
+                members = models.ForecastErrorMember.query.filter_by(forecast_error_id=error.id)\
+                                                          .order_by(models.ForecastErrorMember.id).all()
+                assert_equals([(m.classifier_id, m.regression_model_id, m.name) for m in members],
+                              [(11, None, 'first'), (12, None, 'second'), (None, 21, 'regression')])
+
+    def test_activate_models(self):
+        app = zoopredict_web.app
+        with app.app_context():
+            classifier = models.Classifier(train.CLASSIFIERS['svc'](), 'SVC', active=True)
+            models.db.session.add(classifier)
+            models.db.session.commit()
+            try:
+                prediction_models.set_active(predictor.CLASSIFIER, classifier.id, False)
+                assert_false(models.Classifier.query.get(classifier.id).active)
+                prediction_models.set_active(predictor.CLASSIFIER, classifier.id, True)
+                assert_true(models.Classifier.query.get(classifier.id).active)
+                with assert_raises(LookupError):
+                    prediction_models.set_active(predictor.REGRESSION_MODEL, -1, False)
+            finally:
+                models.Classifier.query.filter_by(id=classifier.id).delete(synchronize_session=False)
+                models.db.session.commit()
+
+    def test_add_missing_columns(self):
+        directory = tempfile.mkdtemp()
+        try:
+            app = appfactory.create_app(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(directory, "test.db")
+            with app.app_context():
+                # a classifier table from before models could be weighted and deactivated
+                models.db.session.execute("CREATE TABLE classifier (id INTEGER PRIMARY KEY, model BLOB NOT NULL, "
+                                          "name VARCHAR)")
+                models.db.session.execute("INSERT INTO classifier (model, name) VALUES (x'00', 'old')")
+                added = initdb.add_missing_columns(models.db)
+                models.db.session.commit()
+                assert_equals(sorted(added), ['classifier.active', 'classifier.weight'])
+                assert_equals(models.db.session.query(models.Classifier.active, models.Classifier.weight).all(),
+                              [(True, 1.0)])
+                assert_equals(initdb.add_missing_columns(models.db), [])
+                models.db.session.remove()
+                models.db.get_engine(app).dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_retention(self):
+        assert_equals(retention.retention_cutoff(datetime.date(2017, 3, 20), 30), datetime.date(2017, 2, 1))
+
+        with zoopredict_web.app.app_context():
+            for day, temp_max in [(1, 1.0), (1, 3.0), (2, 5.0)]:
+                models.db.session.add(models.WeatherForecast(datetime.date(2013, 5, day), temp_max=temp_max,
+                                                             precipitation=1.0))
+            models.db.session.commit()
+
+            report = retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=1, dry_run=True)
+            affected = dict((name, rows) for name, rows, _ in report)
+            assert_true(affected['delete_superseded_forecasts'] >= 1)
+            assert_true(affected['roll_up_forecasts'] >= 2)
+
+            retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=1)
+            assert_equals(models.WeatherForecast.query.filter(
+                models.WeatherForecast.date < datetime.date(2017, 2, 1)).count(), 0)
+
+            # the superseded forecast of May 1st is not included in the aggregate
+            monthly = models.WeatherForecastMonthly.query.filter_by(year=2013, month=5).one()
+            assert_equals(monthly.days, 2)
+            assert_almost_equals(monthly.temp_max, 4.0)
+            assert_almost_equals(monthly.precipitation, 2.0)
+
+            # a forecast arriving late for a month already rolled up is merged into its aggregate
+            models.db.session.add(models.WeatherForecast(datetime.date(2013, 5, 3), temp_max=8.0, precipitation=2.0))
+            models.db.session.commit()
+            retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=1)
+            monthly = models.WeatherForecastMonthly.query.filter_by(year=2013, month=5).one()
+            assert_equals(monthly.days, 3)
+            assert_almost_equals(monthly.temp_max, (3.0 + 5.0 + 8.0) / 3)
+            assert_almost_equals(monthly.precipitation, 4.0)
+            assert_equals(models.WeatherForecast.query.filter(
+                models.WeatherForecast.date < datetime.date(2017, 2, 1)).count(), 0)
+
+    def test_retention_failure(self):
+        forecast, monthly = models.WeatherForecast, models.WeatherForecastMonthly
+        july = (forecast.date >= datetime.date(2013, 7, 1), forecast.date < datetime.date(2013, 8, 1))
+        with zoopredict_web.app.app_context():
+            for day in [1, 2]:
+                models.db.session.add(forecast(datetime.date(2013, 7, day), temp_max=10.0, precipitation=1.0))
+            models.db.session.commit()
+
+            # fail after the month has been aggregated but before its daily rows are deleted
+            store_monthly = retention._store_monthly
+
+            def failing_store_monthly(monthly_model, rows, *args):
+                stored = store_monthly(monthly_model, rows, *args)
+                if monthly_model is monthly and tuple(rows[0][:2]) == (2013, 7):
+                    raise RuntimeError("simulated failure")
+                return stored
+
+            retention._store_monthly = failing_store_monthly
+            try:
+                with assert_raises(RuntimeError):
+                    retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=10)
+            finally:
+                retention._store_monthly = store_monthly
+            assert_equals(monthly.query.filter_by(year=2013, month=7).count(), 0)
+            assert_equals(forecast.query.filter(*july).count(), 2)
+
+            # the next run aggregates the rows only once
+            retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=10)
+            assert_equals(monthly.query.filter_by(year=2013, month=7).one().days, 2)
+            assert_equals(forecast.query.filter(*july).count(), 0)
+
+    def test_retention_duplicate_actuals(self):
+        app = zoopredict_web.app
+        class_table = visitor_classes.for_app(app)
+        date = datetime.date(2013, 6, 1)
+        with app.app_context():
+            models.db.session.add(models.ZooStatisticPrediction(date, 100, class_table.classify(100)))
+            # the actual value was corrected; only the latest one counts
+            models.db.session.add(models.ZooStatisticActual(date, 300, class_table.classify(300)))
+            models.db.session.add(models.ZooStatisticActual(date, 120, class_table.classify(120)))
+            models.db.session.commit()
+            try:
+                version = models.get_data_version()
+                retention.run_retention(datetime.date(2017, 3, 20), 30, batch_size=10)
+                # the rolled-up prediction disappears from the web UI, so its cached fragments are invalidated
+                assert_true(models.get_data_version() > version)
+                monthly = models.ZooStatisticPredictionMonthly.query.filter_by(year=2013, month=6).one()
+                assert_equals(monthly.days, 1)
+                assert_equals(monthly.days_with_actual, 1)
+                assert_almost_equals(monthly.absolute_error_sum, 20)
+            finally:
+                models.ZooStatisticActual.query.filter_by(date=date).delete(synchronize_session=False)
+                models.db.session.commit()
+
+    def test_visitor_classes(self):
+        table = visitor_classes.VisitorClassTable(zoopredict_web.app.config['VISITOR_CLASSES'])
+        assert_equals(table.classify(0), 0)
+        assert_equals(table.classify(100), 0)
+        assert_equals(table.classify(101), 1)
+        assert_equals(table.classify(251), 2)
+        assert_equals(table.classify(-1), 0)
+        assert_equals(list(table.classify(pd.Series([5, 150, 1000]).values)), [0, 1, 2])
+        assert_equals(zoopredict_web.visitors_class_to_label(2), 'high')
+
+        with zoopredict_web.app.app_context():
+            # rows stored by other tests must not count
+            visitor_classes.reclassify_stored_rows(table)
+            row = models.ZooStatisticActual(datetime.date(2014, 1, 1), 101, 0)
+            models.db.session.add(row)
+            models.db.session.commit()
+            try:
+                assert_equals(visitor_classes.reclassify_stored_rows(table, dry_run=True), 1)
+                assert_equals(visitor_classes.reclassify_stored_rows(table), 1)
+                assert_equals(visitor_classes.reclassify_stored_rows(table, dry_run=True), 0)
+                assert_equals(models.ZooStatisticActual.query.get(row.id).visitors_class, 1)
+            finally:
+                models.ZooStatisticActual.query.filter_by(id=row.id).delete(synchronize_session=False)
+                models.db.session.commit()
+
+    def test_backtest(self):
+        dates = np.arange('2010-01-01', '2010-04-01', dtype='datetime64[D]')
+        X = np.column_stack([np.arange(len(dates)), np.ones(len(dates))])
+        targets = {backtest.REGRESSION: 2 * np.arange(len(dates)),
+                   backtest.CLASSIFICATION: np.arange(len(dates)) % 2}
+
+        expanding = backtest.Backtester(dates, X, targets, min_train_size=20)
+        assert_equals([period for period, _, _ in expanding.splits()], ['2010-02', '2010-03'])
+
+        sliding = backtest.Backtester(dates, X, targets, window_days=14, min_train_size=10)
+        _, train_rows, test_rows = sliding.splits()[-1]
+        assert_equals(test_rows.start - train_rows.start, 14)
+
+        candidates = [c for c in backtest.DEFAULT_CANDIDATES if c.name in ('LinearRegression', 'LogisticRegression')]
+        results = expanding.run(candidates, n_jobs=1)
+        assert_equals(len(results), 4)
+        assert_almost_equals(results['mean_absolute_error'].max(), 0.0)
+
+        # each model is summarized over the metrics of its own task only
+        summary = backtest.summarize(results)
+        regression = summary.loc[(backtest.REGRESSION, 'LinearRegression')]
+        classification = summary.loc[(backtest.CLASSIFICATION, 'LogisticRegression')]
+        assert_almost_equals(regression['mean_absolute_error'], 0.0)
+        assert_true(np.isnan(regression['accuracy']))
+        assert_true(0.0 <= classification['accuracy'] <= 1.0)
+        assert_true(np.isnan(classification['mean_absolute_error']))
+
+    def test_scheduler(self):
+        app = zoopredict_web.app
+        runs = []
+        jobs = {'test_job': lambda app: runs.append(1), 'failing_job': lambda app: 1 / 0}
+        schedules = {'test_job': {'interval': 60 * 60}, 'failing_job': {'daily_at': '05:00'}}
+        job_scheduler = scheduler.Scheduler(app, schedules, jobs=jobs, owner='test')
+
+        now = datetime.datetime(2017, 3, 1, 12, 0)
+        assert_equals(job_scheduler.next_run_time('failing_job', None, now), datetime.datetime(2017, 3, 2, 5, 0))
+        # a missed run is due right away
+        assert_equals(job_scheduler.next_run_time('failing_job', datetime.datetime(2017, 2, 27, 5, 1), now),
+                      datetime.datetime(2017, 2, 28, 5, 0))
+
+        with app.app_context():
+            assert_true(scheduler.acquire_lock('test_job', 'other', 60))
+        assert_false(job_scheduler.run_job('test_job'))
+        with app.app_context():
+            scheduler.release_lock('test_job', 'other')
+
+        assert_equals(job_scheduler.run_pending(), ['test_job'])
+        assert_equals(runs, [1])
+
+        assert_true(job_scheduler.run_job('failing_job'))
+        with app.app_context():
+            run = models.JobRun.query.filter_by(job='failing_job').one()
+            assert_false(run.succeeded)
+            assert_in('ZeroDivisionError', run.error)
+            assert_equals(models.JobLock.query.count(), 0)
+
+    def test_store_models(self):
+        app = zoopredict_web.app
+        classifier = train.CLASSIFIERS['svc']()
+        regr_model = train.QuantileRegressionModel(train.REGRESSION_MODELS['linear_regression'](), [0.5], [0.0])
+        model_classes = [models.Classifier, models.RegressionModel]
+        with app.app_context():
+            previously_active = [[m.id for m in model_class.query.filter_by(active=True)]
+                                 for model_class in model_classes]
+
+        first = train._store_models(app, classifier, regr_model, 1.0)
+        second = train._store_models(app, classifier, regr_model, 1.0)
+        # the scheduled retraining deactivates the ensemble instead of deleting it
+        third = train._store_models(app, classifier, regr_model, 2.0, train._deactivate_existing)
+        try:
+            with app.app_context():
+                assert_equals([c.id for c in models.Classifier.query.filter_by(active=True)], [third[0]])
+                assert_equals([r.id for r in models.RegressionModel.query.filter_by(active=True)], [third[1]])
+                assert_false(models.Classifier.query.get(first[0]).active)
+                assert_false(models.RegressionModel.query.get(second[1]).active)
+        finally:
+            with app.app_context():
+                for i, model_class in enumerate(model_classes):
+                    stored = [ids[i] for ids in (first, second, third)]
+                    model_class.query.filter(model_class.id.in_(stored)).delete(synchronize_session=False)
+                    if previously_active[i]:
+                        model_class.query.filter(model_class.id.in_(previously_active[i]))\
+                                   .update({model_class.active: True}, synchronize_session=False)
+                models.db.session.commit()
+
+    def test_zoo_statistics_with_empty_days(self):
+        class Cell(object):
+            def __init__(self, value):
+                self.value = value
+
+        class Worksheet(object):
+            def iter_rows(self):
+                # the day counts are in the fourth column from the sixth row on
+                header = [[Cell(None)] * 4] * 5
+                days = [[Cell(None)] * 3 + [Cell(visitors)] for visitors in [120, None, 300] + [None] * 28]
+                return iter(header + days)
+
+        dates = [datetime.date(2017, 3, day) for day in range(1, 5)]
+        table = visitor_classes.for_app(zoopredict_web.app)
+        statistics = zoodatafetcher._read_daylist_from_month_statistic(Worksheet(), dates, table)
+        # an empty day is skipped, not the rest of the month
+        assert_equals([(s.date.day, s.visitors) for s in statistics], [(1, 120), (3, 300)])
+
+    def test_harvest_checkpoints(self):
+        start, end = checkpoints.backfill_window(datetime.date(2012, 6, 6), 5)
+        assert_equals((start, end), (datetime.date(2012, 6, 1), datetime.date(2012, 6, 5)))
+
+        with zoopredict_web.app.app_context():
+            models.db.session.add(models.WeatherObservation(datetime.date(2012, 6, 2), temp_max=20.0))
+            checkpoints.mark_harvested(checkpoints.FMI_OBSERVATION, [datetime.date(2012, 6, 4)])
+            models.db.session.commit()
+
+            missing = checkpoints.missing_dates(checkpoints.FMI_OBSERVATION, start, end, models.WeatherObservation)
+            assert_equals(missing, [datetime.date(2012, 6, 1), datetime.date(2012, 6, 3), datetime.date(2012, 6, 5)])
+            assert_equals(len(checkpoints.missing_dates(checkpoints.ZOO_STATISTIC, start, end)), 5)
+
+    def test_index_fragment_cache(self):
+        app = zoopredict_web.app
+        client = app.test_client()
+        with app.app_context():
+            models.db.session.add(models.ZooStatisticPrediction(datetime.date(2099, 1, 1), 200, 1))
+            models.db.session.add(models.ZooStatisticActual(datetime.date(2099, 1, 1), 220, 1))
+            models.bump_data_version()
+            models.db.session.commit()
+        assert_in(b'2099-01-01', client.get('/').data)
+
+        def prediction_queries():
+            recorder = profiling.SQLQueryRecorder()
+            recorder.start()
+            try:
+                response = client.get('/')
+            finally:
+                recorder.stop()
+            assert_equals(response.status_code, 200)
+            return [s for s in recorder.queries if 'zoo_statistic_prediction' in s]
+
+        # served from the cache until the data version changes
+        assert_equals(prediction_queries(), [])
+        with app.app_context():
+            models.bump_data_version()
+            models.db.session.commit()
+        assert_true(prediction_queries())
+
+    def test_ensemble_prediction(self):
+        class ConstantModel(object):
+            def __init__(self, value):
+                self.value = value
+
+            def predict(self, X):
+                return np.full(len(X), self.value)
+
+        registry = predictor.ModelRegistry(workers=2)
+        registry.classifiers = [predictor.LoadedModel(1, 'low', ConstantModel(0), 1.0),
+                                predictor.LoadedModel(2, 'high', ConstantModel(2), 0.75),
+                                predictor.LoadedModel(3, 'high2', ConstantModel(2), 0.5)]
+        registry.regression_models = [predictor.LoadedModel(1, 'small', ConstantModel(100.0), 3.0),
+                                      predictor.LoadedModel(2, 'large', ConstantModel(200.0), 1.0)]
+        registry.version = ('test',)
+
+        classes, visitors, quantiles, members = registry.predict_features_with_members([10.0, 12.0], [0.0, 1.0],
+                                                                                       [0, 5])
+        assert_equals(classes, [2, 2])
+        assert_almost_equals(visitors[0], 125.0)
+        assert_equals(quantiles, [None, None])
+        assert_equals([m.value for m in members[1]], [0, 2, 2, 100.0, 200.0])
+        assert_equals(registry.classifier_id, None)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# A load test for the ZooPredict web app.
+#
+# Seeds a database with synthetic predictions and actual values at a
+# configurable scale and requests a page from several concurrent clients,
+# reporting throughput, latency percentiles, the number of SQL queries per
+# request and whether latency holds steady over the course of the run.
+#
+# By default a temporary SQLite database is seeded and the app is driven
+# in-process through the Flask test client. --database-url seeds another
+# database, e.g. PostgreSQL, and --url drives an already running server over
+# HTTP instead; query counts are only available in-process.
+#
+# Run from the repository root: python -m tools.loadtest
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+import requests
+
+import models
+import profiling
+import visitor_classes
+import zoopredict_web
+
+PERCENTILES = [50, 90, 95, 99]
+
+# rows per bulk insert when seeding
+SEED_BATCH_SIZE = 5000
+
+
+def seed_database(app, days, predictions_per_day=1, actual_ratio=1.0):
+    """
+    Creates the tables and inserts synthetic predictions and actual values for
+    the given number of days ending today. Uses only portable SQL, so any
+    database supported by the app can be seeded.
+    :param days: the number of days to seed
+    :param predictions_per_day: the number of predictions per day, as stored by repeated harvester runs
+    :param actual_ratio: the fraction of days that get an actual value
+    :return: a tuple (number of predictions, number of actual values) in the database
+    """
+    class_table = visitor_classes.for_app(app)
+    today = datetime.date.today()
+    predictions = []
+    actuals = []
+
+    with app.app_context():
+        models.db.create_all()
+        session = models.db.session
+
+        def flush(model, rows):
+            session.bulk_insert_mappings(model, rows)
+            del rows[:]
+
+        for offset in range(days):
+            date = today - datetime.timedelta(days=offset)
+            # the predictions and the actual value of a day scatter around the same level
+            level = random.randint(0, 600)
+            for _ in range(predictions_per_day):
+                predicted = max(0, level + random.randint(-100, 100))
+                predictions.append({'date': date, 'visitors': predicted,
+                                    'visitors_class': class_table.classify(predicted),
+                                    'visitors_low': max(0, predicted - 80), 'visitors_median': predicted,
+                                    'visitors_high': predicted + 80})
+            if random.random() < actual_ratio:
+                actual = max(0, level + random.randint(-100, 100))
+                actuals.append({'date': date, 'visitors': actual, 'visitors_class': class_table.classify(actual)})
+
+            if len(predictions) >= SEED_BATCH_SIZE:
+                flush(models.ZooStatisticPrediction, predictions)
+            if len(actuals) >= SEED_BATCH_SIZE:
+                flush(models.ZooStatisticActual, actuals)
+
+        flush(models.ZooStatisticPrediction, predictions)
+        flush(models.ZooStatisticActual, actuals)
+        models.bump_data_version()
+        session.commit()
+
+        return models.ZooStatisticPrediction.query.count(), models.ZooStatisticActual.query.count()
+
+
+def run_clients(app, path, clients, requests_per_client, base_url=None):
+    """
+    Requests the given path from concurrent clients, either in-process
+    through the Flask test client or over HTTP from base_url.
+    :return: a tuple (list of (start time, latency, query count) tuples, number of failed requests);
+             the query count is None when requesting over HTTP
+    """
+    timings = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client():
+        if base_url:
+            http_session = requests.Session()
+            get = lambda: http_session.get(base_url.rstrip('/') + path)
+            recorder = None
+        else:
+            get = lambda: app.test_client().get(path)
+            recorder = profiling.SQLQueryRecorder()
+            recorder.start()
+
+        try:
+            for _ in range(requests_per_client):
+                queries_before = recorder.query_count if recorder else None
+                start = time.time()
+                try:
+                    status_code = get().status_code
+                except requests.RequestException:
+                    status_code = None
+                latency = time.time() - start
+                queries = recorder.query_count - queries_before if recorder else None
+                with lock:
+                    timings.append((start, latency, queries))
+                    if status_code != 200:
+                        errors[0] += 1
+        finally:
+            if recorder:
+                recorder.stop()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return timings, errors[0]
+
+
+def build_report(timings, errors, elapsed):
+    """
+    Summarizes the timings of a load test run.
+    :return: a dict of the results, latencies in milliseconds
+    """
+    timings = sorted(timings)
+    latencies = 1000 * np.array([latency for _, latency, _ in timings])
+    half = len(timings) // 2
+    queries = [q for _, _, q in timings if q is not None]
+
+    report = {
+        'requests': len(timings),
+        'failed': errors,
+        'seconds': elapsed,
+        'throughput': len(timings) / elapsed if elapsed else None,
+        'latency_ms': {
+            'mean': latencies.mean() if len(latencies) else None,
+            'max': latencies.max() if len(latencies) else None,
+            'first_half_mean': latencies[:half].mean() if half else None,
+            'second_half_mean': latencies[half:].mean() if half else None,
+        },
+        'queries_per_request': None,
+    }
+    for p in PERCENTILES:
+        report['latency_ms']['p{p}'.format(p=p)] = np.percentile(latencies, p) if len(latencies) else None
+    if queries:
+        report['queries_per_request'] = {'mean': float(np.mean(queries)), 'max': int(max(queries))}
+
+    # numpy scalars are not JSON serializable
+    report['latency_ms'] = {k: float(v) if v is not None else None for k, v in report['latency_ms'].items()}
+    return report
+
+
+def _print_report(report):
+    latency = report['latency_ms']
+    print("Requests: {n}, failed: {e}".format(n=report['requests'], e=report['failed']))
+    print("Throughput: {t:.1f} requests/s".format(t=report['throughput']))
+    print("Latency: mean {m:.1f} ms, ".format(m=latency['mean']) +
+          ", ".join("p{p} {v:.1f} ms".format(p=p, v=latency['p{p}'.format(p=p)]) for p in PERCENTILES) +
+          ", max {m:.1f} ms".format(m=latency['max']))
+    print("Mean latency, first half of the run: {l:.1f} ms".format(l=latency['first_half_mean']))
+    print("Mean latency, second half of the run: {l:.1f} ms".format(l=latency['second_half_mean']))
+    if report['queries_per_request']:
+        print("SQL queries per request: mean {m:.1f}, max {x}".format(m=report['queries_per_request']['mean'],
+                                                                     x=report['queries_per_request']['max']))
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--clients', dest='clients', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('-n', '--requests', dest='requests', type=int, default=50,
+                        help='number of requests per client')
+    parser.add_argument('-d', '--days', dest='days', type=int, default=365,
+                        help='number of days of synthetic predictions and actual values to seed')
+    parser.add_argument('-p', '--predictions-per-day', dest='predictions_per_day', type=int, default=1,
+                        help='number of synthetic predictions to seed per day')
+    parser.add_argument('-a', '--actual-ratio', dest='actual_ratio', type=float, default=1.0,
+                        help='fraction of days to seed an actual value for')
+    parser.add_argument('--database-url', dest='database_url', default=None,
+                        help='seed this database instead of a temporary SQLite database')
+    parser.add_argument('--no-seed', dest='seed', action='store_false', default=True,
+                        help='use the data already in the database')
+    parser.add_argument('--url', dest='url', default=None,
+                        help='load test a running server at this base URL instead of the app in-process')
+    parser.add_argument('--path', dest='path', default='/',
+                        help='the path to request')
+    parser.add_argument('-o', '--output-path', dest='output_path', default=None,
+                        help='write the report into this file as JSON')
+    return parser
+
+
+def main():
+    argparser = _get_arg_parser()
+    args = argparser.parse_args()
+    # the report needs at least one request
+    if args.clients <= 0 or args.requests <= 0:
+        argparser.error("the number of clients and of requests per client must be positive")
+
+    app = zoopredict_web.app
+    if args.database_url:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    elif not args.url:
+        database_path = os.path.join(tempfile.mkdtemp(), "loadtest.db")
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + database_path
+
+    # against an external server only the database it uses can be seeded
+    if args.seed and (args.database_url or not args.url):
+        print("Seeding {d} days of data into {u}".format(d=args.days, u=app.config['SQLALCHEMY_DATABASE_URI']))
+        predictions, actuals = seed_database(app, args.days, args.predictions_per_day, args.actual_ratio)
+        print("Database holds {p} predictions and {a} actual values".format(p=predictions, a=actuals))
+
+    start = time.time()
+    timings, errors = run_clients(app, args.path, args.clients, args.requests, base_url=args.url)
+    elapsed = time.time() - start
+
+    report = build_report(timings, errors, elapsed)
+    # the database URL may contain credentials
+    report['parameters'] = {k: v for k, v in vars(args).items() if k != 'database_url'}
+    _print_report(report)
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Wrote the report into {p}".format(p=args.output_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,213 @@
-import openpyxl.reader.excel
+#!/usr/bin/env python
+
+# Extracts the historical daily zoo visitor counts from the yearly Excel
+# workbooks in data/ into data/oldVisitorCounts.csv, and the yearly totals since
+# 1955 from Kavijatilasto_alkaen1955.xlsx into data/yearlyVisitorCounts.csv.
+#
+# The workbooks are processed in parallel, one process per year, and the rows
+# extracted from each workbook are cached by the workbook's content hash, so
+# regenerating the output only reads workbooks that have changed.
+
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
 from datetime import date
 
-class oldZooDataExtractor:
+import openpyxl.reader.excel
 
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data"))
+CACHE_DIR = os.path.join(DATA_DIR, ".extract_cache")
+YEARLY_WORKBOOK_PATTERN = os.path.join(DATA_DIR, "Kävijätilasto_*.xlsx")
+HISTORY_WORKBOOK_PATH = os.path.join(DATA_DIR, "Kavijatilasto_alkaen1955.xlsx")
 
-    # Names that match the sheet names in the source Excel workbook for month collection
-    month_dict = ["Yht1", "Yht2", "Yht3", "Yht4", "Yht5", "Yht6", "Yht7", "Yht8", "Yht9", "Yht10", "Yht11", "Yht12"]
-    headers = ["day","month","year","visitors","datetime","weekday"]
-    weekdays = ["Mon","Tue","Wed","Thu","Fri","Sat","Sun"]
+DEFAULT_MONTHS = [1, 2, 3]
 
+# bump when the extraction logic changes to invalidate cached results
+CACHE_FORMAT_VERSION = 1
 
-    def __init__(self, history=False,):
-        self.output = []
-        self.output_filename = "../data/oldVisitorCounts.csv"
-        # data_only reads only evaluated values and never returns formulas
-        # file = "../data/Kävijätilasto_2015.xlsx"
-        # Which months to be included 1-12
-        months_included = [1,2,3]
-        #Which years to be included 2016-2011
-        #years = [2016, 2015, 2014, 2013, 2012, 2011, 2010]
-        years = [2010, 2011, 2012, 2013, 2014, 2015, 2016]
 
-        for year in years:
-            self.output.append(self.read_one_year_statistics(months_included,year))
+class oldZooDataExtractor:
 
-        if not history:
-            # Write to actual file
-            self.write_to_file()
+    # Names that match the sheet names in the source Excel workbook for month collection
+    month_dict = ["Yht1", "Yht2", "Yht3", "Yht4", "Yht5", "Yht6", "Yht7", "Yht8", "Yht9", "Yht10", "Yht11", "Yht12"]
+    headers = ["day", "month", "year", "visitors", "datetime", "weekday"]
+    weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
 
+    # layout of the month sheets: days are on rows 5-35, the day of month in
+    # column A and the day's total visitor count in column AD (30)
+    first_day_row = 5
+    last_day_row = 35
+    visitors_column = 30
 
-    def read_one_year_statistics(self, months_included, year):
-        file = "../data/Kävijätilasto_" + str(year) + ".xlsx"
-        workbook = openpyxl.reader.excel.load_workbook(file, read_only=True, data_only=True)
-        result = []
-        for month in months_included:
-            result.append(self.read_month_statistics(month, workbook, year))
+    # layout of the yearly totals sheet in the 1955- history workbook
+    history_sheet = "Taulukko"
+    history_first_row = 10
+    history_total_column = 6
 
-        return result
+    def __init__(self, history=False, months=DEFAULT_MONTHS, years=None, workers=None, use_cache=True):
+        self.output_filename = os.path.join(DATA_DIR, "oldVisitorCounts.csv")
+        self.yearly_output_filename = os.path.join(DATA_DIR, "yearlyVisitorCounts.csv")
+        self.months = sorted(months)
+        self.use_cache = use_cache
 
-    def read_month_statistics(self,month, workbook,year):
-        month_sheet = workbook[self.month_dict[month-1]]
-        values = list(month_sheet.iter_rows())[4:]
-        valueList = []
+        workbooks = find_yearly_workbooks()
+        if years is not None:
+            workbooks = {year: path for year, path in workbooks.items() if year in years}
 
-        for item in values:
-            if item[0].value != None :
-                valueList.append([item[0].value, month, year, item[29].value])
+        self.output = self.read_years(workbooks, workers)
+        self.yearly_totals = self.read_yearly_totals()
 
-        return valueList
+        if not history:
+            # Write to actual file
+            self.write_to_file()
 
-    def write_to_file(self):
-        file = open(self.output_filename,"w")
-        file.write(",".join(self.headers) + "\n")
-        for year in self.output:
-            for month in year:
-                for day in month:
-                    currentDate = date(day=day[0],month=day[1],year=day[2])
-                    file.write(str(day[0])+ ","+str(day[1])+","+ str(day[2]) +","+str(day[3]) +","+ currentDate.isoformat() + "," + self.weekdays[currentDate.weekday()]+"\n")
-        file.close()
+    def read_years(self, workbooks, workers=None):
+        """
+        Reads the daily visitor counts for the given years in parallel.
+        :param workbooks: dict of workbook paths by year
+        :return: list of [day, month, year, visitors] rows sorted by date
+        """
+        rows = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(read_one_year_statistics, path, year, self.months, self.use_cache)
+                       for year, path in sorted(workbooks.items())]
+            for future in futures:
+                rows.extend(future.result())
+        return rows
+
+    def read_yearly_totals(self):
+        if not os.path.exists(HISTORY_WORKBOOK_PATH):
+            return []
+        return _cached(HISTORY_WORKBOOK_PATH, "yearly", self.use_cache, _read_yearly_totals, HISTORY_WORKBOOK_PATH)
 
+    def write_to_file(self):
+        lines = []
+        for day, month, year, visitors in self.output:
+            current_date = date(day=day, month=month, year=year)
+            lines.append([day, month, year, visitors, current_date.isoformat(), self.weekdays[current_date.weekday()]])
+
+        with open(self.output_filename, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(self.headers)
+            writer.writerows(lines)
+
+        if self.yearly_totals:
+            with open(self.yearly_output_filename, "w", newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(["year", "visitors"])
+                writer.writerows(self.yearly_totals)
+
+
+def find_yearly_workbooks():
+    """
+    Finds the yearly visitor statistic workbooks in the data directory.
+    :return: dict of workbook paths by year
+    """
+    workbooks = {}
+    for path in glob.glob(YEARLY_WORKBOOK_PATTERN):
+        match = re.search(r"_(\d{4})\.xlsx$", path)
+        if match:
+            workbooks[int(match.group(1))] = path
+    return workbooks
+
+
+def read_one_year_statistics(path, year, months, use_cache=True):
+    """
+    Reads the daily visitor counts of the given months from one yearly workbook.
+    Runs in a worker process.
+    """
+    cache_key = "months-" + "-".join(str(m) for m in months)
+    return _cached(path, cache_key, use_cache, _read_one_year_statistics, path, year, months)
+
+
+def _read_one_year_statistics(path, year, months):
+    # data_only reads only evaluated values and never returns formulas
+    workbook = openpyxl.reader.excel.load_workbook(path, read_only=True, data_only=True)
+    result = []
+    for month in months:
+        result.extend(_read_month_statistics(workbook, month, year))
+    return result
+
+
+def _read_month_statistics(workbook, month, year):
+    extractor = oldZooDataExtractor
+    month_sheet = workbook[extractor.month_dict[month - 1]]
+    rows = month_sheet.iter_rows(min_row=extractor.first_day_row, max_row=extractor.last_day_row,
+                                 min_col=1, max_col=extractor.visitors_column)
+    values = []
+    for row in rows:
+        if len(row) < extractor.visitors_column:
+            continue
+        day = row[0].value
+        if isinstance(day, (int, float)) and 1 <= day <= 31:
+            values.append([int(day), month, year, row[extractor.visitors_column - 1].value])
+    return values
+
+
+def _read_yearly_totals(path):
+    extractor = oldZooDataExtractor
+    workbook = openpyxl.reader.excel.load_workbook(path, read_only=True, data_only=True)
+    rows = workbook[extractor.history_sheet].iter_rows(min_row=extractor.history_first_row,
+                                                        min_col=1, max_col=extractor.history_total_column)
+    totals = []
+    for row in rows:
+        if len(row) < extractor.history_total_column:
+            continue
+        year, total = row[0].value, row[extractor.history_total_column - 1].value
+        # the table is followed by free-form notes, which start with text rows
+        if not re.match(r"^\d{4}$", str(year).strip()) or not isinstance(total, (int, float)):
+            continue
+        totals.append([int(str(year).strip()), int(total)])
+    return totals
+
+
+def _cached(path, key, use_cache, func, *args):
+    """
+    Returns the cached result of func(*args) for the workbook at path, keyed by
+    the workbook contents and the given key, computing and storing it if needed.
+    """
+    if not use_cache:
+        return func(*args)
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, "{d}-{k}-v{v}.json".format(d=digest, k=key, v=CACHE_FORMAT_VERSION))
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+
+    result = func(*args)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = "{p}.{pid}.tmp".format(p=cache_path, pid=os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, cache_path)
+    return result
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--months', dest='months', type=int, nargs='+', default=DEFAULT_MONTHS,
+                        help='months to include (1-12); default: 1 2 3')
+    parser.add_argument('-y', '--years', dest='years', type=int, nargs='+', default=None,
+                        help='years to include; default: all workbooks found in the data directory')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=None,
+                        help='number of worker processes; default: number of CPUs')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+                        help='ignore and do not update the extraction cache')
+    return parser
 
 
 if __name__ == "__main__":
-    test = oldZooDataExtractor()
-
-
+    args = _get_arg_parser().parse_args()
+    extractor = oldZooDataExtractor(months=args.months, years=args.years, workers=args.workers,
+                                    use_cache=args.use_cache)
+    print("Wrote {n} days into {p}".format(n=len(extractor.output), p=extractor.output_filename))
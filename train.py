@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 # A command-line utility that loads weather data and zoo visitor data from CSV
-# files and trains scikit-learn classification and regression models based on
-# the data.
+# files, a columnar dataset store (see dataset.py) or the database and trains
+# scikit-learn classification and regression models based on the data.
 
 from __future__ import print_function
 
@@ -14,14 +14,20 @@ import pickle
 
 import numpy as np
 import pandas as pd
-from flask import Flask
 from sklearn import linear_model
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.metrics import mean_squared_error, mean_absolute_error, median_absolute_error, make_scorer
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import cross_val_predict, cross_val_score
 from sklearn.svm import SVC
 
+import appfactory
 import config
+import dataset
+import metrics
 import models
+import profiling
+import visitor_classes
 
 PREDICTORS_WEEKDAYS = ['weekday_' + wd for wd in config.WEEKDAYS]
 PREDICTORS_WEATHER = ['temp_max', 'precipitation']
@@ -35,9 +41,55 @@ DEFAULT_WEATHER_TRAINING_DATA_PATH = "data/weather_observations_jan-mar_2010-201
 DEFAULT_CLASSIFIER_OUTPUT_PATH = "classifier.dump"
 DEFAULT_REGRESSION_MODEL_OUTPUT_PATH = "regression_model.dump"
 
+# The estimators that can be trained, by command-line name; the first ones are the defaults.
+# Training several with --keep-existing makes the predictor use them as an ensemble.
+CLASSIFIERS = collections.OrderedDict([
+    ('svc', lambda: SVC(C=1, kernel='linear')),
+    ('logistic_regression', lambda: linear_model.LogisticRegression()),
+    ('random_forest', lambda: RandomForestClassifier(n_estimators=50, random_state=0)),
+])
+REGRESSION_MODELS = collections.OrderedDict([
+    ('linear_regression', lambda: linear_model.LinearRegression()),
+    ('ridge', lambda: linear_model.Ridge()),
+    ('random_forest', lambda: RandomForestRegressor(n_estimators=50, random_state=0)),
+])
+
+_FIT_METRIC = "model_fit_seconds"
+_FIT_METRIC_DESCRIPTION = "Time spent fitting prediction models"
+_CV_METRIC = "model_cross_validation_seconds"
+_CV_METRIC_DESCRIPTION = "Time spent cross-validating prediction models"
+
 logger = logging.getLogger(__name__)
 
 
+class QuantileRegressionModel(object):
+    """
+    A fitted regression model that also predicts quantiles of the visitor
+    count. The quantiles are the point prediction shifted by the empirical
+    quantiles of the model's out-of-fold residuals on the training data.
+    """
+
+    def __init__(self, model, quantiles, residual_quantiles):
+        self.model = model
+        self.quantiles = list(quantiles)
+        self.residual_quantiles = np.asarray(residual_quantiles, dtype=np.float64)
+
+    @property
+    def name(self):
+        return type(self.model).__name__
+
+    def predict(self, X):
+        return self.model.predict(X)
+
+    def predict_quantiles(self, X):
+        """
+        Predicts the configured quantiles for all rows of X at once.
+        :return: an array with one row per row of X and one column per quantile
+        """
+        predicted = self.model.predict(X)
+        return np.maximum(predicted[:, np.newaxis] + self.residual_quantiles[np.newaxis, :], 0.0)
+
+
 class ModelBuilder(object):
 
     def __init__(self, app, weather_data, visitor_data):
@@ -48,8 +100,9 @@ class ModelBuilder(object):
         full_data = pd.merge(visitor_data, weather_data, on='datetime')
 
         # the datetime column is irrelevant as a feature and makes conversion
-        # to a numeric array more difficult, so remove it
-        del full_data['datetime']
+        # to a numeric array more difficult, so remove it (but keep the dates
+        # for evaluation in time order)
+        self.dates = pd.to_datetime(full_data.pop('datetime')).values.astype('datetime64[D]')
 
         # convert categorical features to binary numerical features
         self.data = pd.get_dummies(full_data, columns=['weekday'])
@@ -61,63 +114,73 @@ class ModelBuilder(object):
 
     def _preprocess_visitor_data(self, data):
         # add visitor count classes to the data frame
-        visitor_classes_config = self._app.config['VISITOR_CLASSES']
-
-        classes_by_rank = collections.OrderedDict(sorted(visitor_classes_config.items(),
-                                                  key=lambda class_dict: class_dict[1]['min']))
-
-        # use numeric indexes as class labels (makes things easier with scikit-learn)
-        class_labels = [i for i, c in enumerate(classes_by_rank)]
-        class_lower_thresholds = [c['min'] for c in classes_by_rank.values()]
-
-        # Split the data into bins based on the class theresholds.
-        # pd.cut seems to want a max value for the last bin too, so add infinity as max.
-        class_lower_thresholds.append(float('inf'))
-
-        classification = pd.cut(data['visitors'], class_lower_thresholds,
-                                labels=class_labels, include_lowest=True)
-        data['visitors_class'] = classification
+        class_table = visitor_classes.for_app(self._app)
+        data['visitors_class'] = class_table.classify(data['visitors'].values)
 
         # add visitor counts normalized by weekday
         visitors_normalized = data.groupby('weekday')['visitors'].transform(lambda x: x / x.mean())
         data['visitors_normalized'] = visitors_normalized
 
-    def build_classifier(self, predictors=DEFAULT_PREDICTORS, target=DEFAULT_CLASSIFICATION_TARGET, cv=10):
+    def build_classifier(self, predictors=DEFAULT_PREDICTORS, target=DEFAULT_CLASSIFICATION_TARGET, cv=10,
+                         estimator=None):
         X = self.data[predictors].as_matrix()
         y = self.data[target].as_matrix()
 
-        classifier = SVC(C=1, kernel='linear')
+        classifier = estimator if estimator is not None else SVC(C=1, kernel='linear')
 
         # produce accuracy estimate through cross-validation
         if cv:
-            scores = cross_val_score(classifier, X, y, cv=cv)
+            with metrics.histogram(_CV_METRIC, _CV_METRIC_DESCRIPTION).time(model='classifier'):
+                scores = cross_val_score(classifier, X, y, cv=cv)
         else:
             scores = None
-        classifier.fit(X, y)
+        with metrics.histogram(_FIT_METRIC, _FIT_METRIC_DESCRIPTION).time(model='classifier'):
+            classifier.fit(X, y)
 
         return classifier, scores
 
-    def build_regression_model(self, predictors=DEFAULT_PREDICTORS, target=DEFAULT_REGRESSION_TARGET, cv=10):
+    def build_regression_model(self, predictors=DEFAULT_PREDICTORS, target=DEFAULT_REGRESSION_TARGET, cv=10,
+                               estimator=None):
         X = self.data[predictors].as_matrix()
         y = self.data[target].as_matrix()
 
-        model = linear_model.LinearRegression()
+        model = estimator if estimator is not None else linear_model.LinearRegression()
 
         # produce accuracy estimate through cross-validation
         if cv:
-            scores = {
-                'mean_absolute_error':
-                    cross_val_score(model, X, y, cv=cv, scoring=make_scorer(mean_absolute_error)),
-                'mean_squared_error':
-                    cross_val_score(model, X, y, cv=cv, scoring=make_scorer(mean_squared_error)),
-                'median_absolute_error':
-                    cross_val_score(model, X, y, cv=cv, scoring=make_scorer(median_absolute_error)),
-            }
+            with metrics.histogram(_CV_METRIC, _CV_METRIC_DESCRIPTION).time(model='regression'):
+                scores = {
+                    'mean_absolute_error':
+                        cross_val_score(model, X, y, cv=cv, scoring=make_scorer(mean_absolute_error)),
+                    'mean_squared_error':
+                        cross_val_score(model, X, y, cv=cv, scoring=make_scorer(mean_squared_error)),
+                    'median_absolute_error':
+                        cross_val_score(model, X, y, cv=cv, scoring=make_scorer(median_absolute_error)),
+                }
         else:
             scores = None
-        model.fit(X, y)
+        with metrics.histogram(_FIT_METRIC, _FIT_METRIC_DESCRIPTION).time(model='regression'):
+            model.fit(X, y)
         return model, scores
 
+    def build_quantile_regression_model(self, quantiles=config.PREDICTION_QUANTILES, predictors=DEFAULT_PREDICTORS,
+                                        target=DEFAULT_REGRESSION_TARGET, cv=10, estimator=None):
+        # the median is stored as the median prediction, so fail before training without it
+        if models.median_index(quantiles) is None:
+            raise ValueError("The quantiles {q} do not include the median (0.5)".format(q=list(quantiles)))
+        model, scores = self.build_regression_model(predictors, target, cv, estimator)
+
+        X = self.data[predictors].as_matrix()
+        y = self.data[target].as_matrix()
+
+        # out-of-fold residuals reflect the errors on unseen days, unlike the
+        # residuals of the model fitted on all of the data
+        with metrics.histogram(_CV_METRIC, _CV_METRIC_DESCRIPTION).time(model='regression_quantiles'):
+            out_of_fold = cross_val_predict(clone(model), X, y, cv=cv or 10)
+        residual_quantiles = np.percentile(y - out_of_fold, [100.0 * q for q in quantiles])
+
+        return QuantileRegressionModel(model, quantiles, residual_quantiles), scores
+
 
 def weather_to_predictors(daily_weather_data, predictors=DEFAULT_PREDICTORS):
     """
@@ -145,38 +208,178 @@ def weather_to_predictors(daily_weather_data, predictors=DEFAULT_PREDICTORS):
     return dataframe[predictors]
 
 
-def _get_arg_parser():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--store-in-database', dest='store_in_database', action='store_true',
-                        help='store the generated models in the database instead of files')
-    parser.add_argument('-k', '--keep-existing', dest='keep_existing', action='store_true', default=False,
-                        help='keep existing models in the database; by default they are dropped')
+def features_to_matrix(temps_max, precipitations, weekdays, predictors=DEFAULT_PREDICTORS):
+    """
+    Builds a feature matrix ready for passing to a classifier or regression
+    model built by ModelBuilder directly from feature values, without
+    constructing weather objects or data frames.
+    :param temps_max: sequence of daily maximum temperatures
+    :param precipitations: sequence of daily precipitation totals
+    :param weekdays: sequence of weekday numbers (0 = Monday, as in date.weekday())
+    :param predictors: the predictor columns, in order
+    :return: a numpy array with one row per day
+    """
+    weekdays = np.asarray(weekdays, dtype=int)
+    columns = {
+        'temp_max': np.asarray(temps_max, dtype=float),
+        'precipitation': np.asarray(precipitations, dtype=float),
+    }
+    for i, weekday in enumerate(config.WEEKDAYS):
+        columns['weekday_' + weekday] = (weekdays == i).astype(float)
+
+    return np.column_stack([columns[p] for p in predictors])
+
+
+def add_data_arguments(parser):
+    """
+    Adds the command-line options selecting the training data source to an argument parser.
+    """
     parser.add_argument('-w', '--weather-data-path', dest='weather_data_path',
                         default=DEFAULT_WEATHER_TRAINING_DATA_PATH,
                         help='path the weather data CSV file')
     parser.add_argument('-v', '--visitor-data-path', dest='visitor_data_path',
                         default=DEFAULT_VISITORS_TRAINING_DATA_PATH,
                         help='path to the visitor data CSV file')
+    parser.add_argument('-s', '--dataset-path', dest='dataset_path', default=None,
+                        help='load the training data from this dataset store instead of the CSV files')
+    parser.add_argument('-D', '--from-database', dest='from_database', action='store_true', default=False,
+                        help='train on the weather observations and actual visitor counts in the database')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=dataset.DEFAULT_CHUNK_SIZE,
+                        help='number of rows to fetch from the database at a time')
+    parser.add_argument('--start-date', dest='start_date', default=None,
+                        help='first date (YYYY-MM-DD) of training data to load from the dataset store or database')
+    parser.add_argument('--end-date', dest='end_date', default=None,
+                        help='last date (YYYY-MM-DD) of training data to load from the dataset store or database')
+
+
+def load_data(app, args):
+    """
+    Loads the training data from the source selected with the options added by add_data_arguments.
+    :return: a tuple (weather data frame, visitor data frame)
+    """
+    if args.from_database:
+        return dataset.load_training_data_from_database(app, args.start_date, args.end_date, args.chunk_size)
+    elif args.dataset_path:
+        store = dataset.DatasetStore(args.dataset_path)
+        return dataset.load_training_data(store, args.start_date, args.end_date)
+    else:
+        return pd.read_csv(args.weather_data_path), pd.read_csv(args.visitor_data_path)
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--store-in-database', dest='store_in_database', action='store_true',
+                        help='store the generated models in the database instead of files')
+    parser.add_argument('-k', '--keep-existing', dest='keep_existing', action='store_true', default=False,
+                        help='keep existing models in the database and use them in an ensemble with the new '
+                             'ones; by default they are dropped')
+    parser.add_argument('-c', '--classifier', dest='classifier', choices=list(CLASSIFIERS),
+                        default=list(CLASSIFIERS)[0], help='the classifier to train')
+    parser.add_argument('-r', '--regression-model', dest='regression_model', choices=list(REGRESSION_MODELS),
+                        default=list(REGRESSION_MODELS)[0], help='the regression model to train')
+    parser.add_argument('-W', '--weight', dest='weight', type=float, default=1.0,
+                        help='the weight of the new models in an ensemble')
+    add_data_arguments(parser)
     parser.add_argument('-V', '--verbose', dest='verbose', action='store_true',
                         help='more verbose output')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        default=profiling.is_enabled_by_environment(),
+                        help='profile the training run and write a report into PROFILE_OUTPUT_DIR')
     return parser
 
 
 def main():
     logging.config.dictConfig(config.LOGGING_CONF)
 
-    app = Flask(__name__)
-    app.config.from_object("config")
+    app = appfactory.create_app(__name__)
 
     argparser = _get_arg_parser()
     args = argparser.parse_args()
+    if args.weight <= 0:
+        argparser.error("the weight must be positive")
+
+    with profiling.profiled('train', app.config['PROFILE_OUTPUT_DIR'], enabled=args.profile):
+        _train(app, args)
+
+    metrics.dump_json_if_configured(app.config)
+
+
+def train_from_database(app, keep_existing=False, classifier=None, regression_model=None, weight=1.0,
+                        start_date=None, end_date=None, chunk_size=dataset.DEFAULT_CHUNK_SIZE):
+    """
+    Trains a classifier and a regression model on the weather observations and
+    actual visitor counts in the database and stores them as active models.
+    The models that were active so far are only deactivated, not deleted, so
+    that an ensemble can be restored by activating its models again.
+    :param keep_existing: keep the models that were active so far in an ensemble with the new ones
+    :param classifier: the name of the classifier to train (see CLASSIFIERS); defaults to the first one
+    :param regression_model: the name of the regression model to train (see REGRESSION_MODELS);
+                             defaults to the first one
+    :param weight: the weight of the new models in an ensemble
+    :return: a tuple (classifier id, regression model id) of the stored models
+    """
+    classifier = classifier or list(CLASSIFIERS)[0]
+    regression_model = regression_model or list(REGRESSION_MODELS)[0]
+    weather_data, visitor_data = dataset.load_training_data_from_database(app, start_date, end_date, chunk_size)
+
+    builder = ModelBuilder(app, weather_data, visitor_data)
+    classifier_object, classification_scores, regr_model, regression_scores = \
+        _build_models(builder, classifier, regression_model)
+    logger.info("Trained {c} with mean accuracy {a} and {r} with mean MAE {m}".format(
+        c=classifier, a=np.mean(classification_scores), r=regression_model,
+        m=np.mean(regression_scores['mean_absolute_error'])))
+
+    existing = None if keep_existing else _deactivate_existing
+    return _store_models(app, classifier_object, regr_model, weight, existing)
+
+
+def _build_models(builder, classifier, regression_model):
+    """
+    :return: a tuple (classifier, classification scores, regression model, regression scores)
+    """
+    classifier_object, classification_scores = builder.build_classifier(estimator=CLASSIFIERS[classifier]())
+    regr_model, regression_scores = builder.build_quantile_regression_model(
+        estimator=REGRESSION_MODELS[regression_model]())
+    return classifier_object, classification_scores, regr_model, regression_scores
+
+
+def _delete_existing(model_class):
+    for model in model_class.query.all():
+        models.db.session.delete(model)
+
+
+def _deactivate_existing(model_class):
+    model_class.query.filter(model_class.active.is_(True)).update({model_class.active: False},
+                                                                  synchronize_session=False)
+
+
+def _store_models(app, classifier, regr_model, weight, existing=None):
+    """
+    Stores a trained classifier and regression model in the database as active models.
+    :param existing: function taking a model class that removes or deactivates the
+                     existing models of the class, or None to keep them active
+    :return: a tuple (classifier id, regression model id) of the stored models
+    """
+    with app.app_context():
+        db = models.db
+        if existing is not None:
+            existing(models.Classifier)
+            existing(models.RegressionModel)
+
+        stored_classifier = models.Classifier(classifier, type(classifier).__name__, weight=weight)
+        stored_regression_model = models.RegressionModel(regr_model, regr_model.name, weight=weight)
+        db.session.add(stored_classifier)
+        db.session.add(stored_regression_model)
+        db.session.commit()
+        return stored_classifier.id, stored_regression_model.id
+
 
-    visitor_data = pd.read_csv(args.visitor_data_path)
-    weather_data = pd.read_csv(args.weather_data_path)
+def _train(app, args):
+    weather_data, visitor_data = load_data(app, args)
 
     builder = ModelBuilder(app, weather_data, visitor_data)
-    classifier, classification_scores = builder.build_classifier()
-    regr_model, regression_scores = builder.build_regression_model()
+    classifier, classification_scores, regr_model, regression_scores = \
+        _build_models(builder, args.classifier, args.regression_model)
 
     if args.verbose:
         print("Cross-validation accuracies for classification:")
@@ -193,18 +396,7 @@ def main():
     print("")
 
     if args.store_in_database:
-        with app.app_context():
-            db = models.db
-            db.init_app(app)
-
-            if not args.keep_existing:
-                existing = models.Classifier.query.all() + models.RegressionModel.query.all()
-                for model in existing:
-                    db.session.delete(model)
-
-            db.session.add(models.Classifier(classifier, type(classifier).__name__))
-            db.session.add(models.RegressionModel(regr_model, type(regr_model).__name__))
-            db.session.commit()
+        _store_models(app, classifier, regr_model, args.weight, None if args.keep_existing else _delete_existing)
     else:
         print("Writing classifier serialization into {p}".format(p=DEFAULT_CLASSIFIER_OUTPUT_PATH))
         with open(DEFAULT_CLASSIFIER_OUTPUT_PATH, 'wb') as f:
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Visitor count classes for ZooPredict
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# The visitor classes are configured in config.VISITOR_CLASSES as lower
+# thresholds: a day belongs to the class with the highest "min" that does not
+# exceed its visitor count. This module compiles the configuration into a
+# sorted threshold table once and classifies single counts and whole arrays
+# with np.searchsorted, so that training, harvesting and the web UI all use
+# exactly the same class boundaries.
+#
+# Each "min" is inclusive: with the default configuration 101 visitors is
+# "medium". The earlier trainer and harvester code both put 101 visitors into
+# "low", so the classes of stored counts that lie exactly on a threshold
+# change when they are reclassified with "python visitor_classes.py".
+
+from __future__ import print_function
+
+import argparse
+import logging
+import logging.config
+
+import numpy as np
+from sqlalchemy import case
+
+import appfactory
+import config
+import models
+
+logger = logging.getLogger(__name__)
+
+_EXTENSION_KEY = 'zoopredict_visitor_classes'
+
+
+class VisitorClassTable(object):
+    """
+    A compiled visitor class configuration.
+    """
+
+    def __init__(self, visitor_classes):
+        """
+        :param visitor_classes: the class configuration, a dict like config.VISITOR_CLASSES
+        """
+        by_threshold = sorted(visitor_classes.items(), key=lambda item: item[1]['min'])
+        self.thresholds = np.array([c['min'] for _, c in by_threshold])
+        self.classes = np.array([key for key, _ in by_threshold])
+        self.labels = {key: c['label'] for key, c in by_threshold}
+
+    def classify(self, visitors):
+        """
+        Returns the visitor class of a visitor count, or an array of classes for
+        an array of counts. Counts below the lowest threshold get the lowest class.
+        """
+        indexes = np.searchsorted(self.thresholds, visitors, side='right') - 1
+        classes = self.classes[np.clip(indexes, 0, len(self.classes) - 1)]
+        if np.ndim(classes) == 0:
+            return classes.item()
+        return classes
+
+    def label(self, visitors_class):
+        return self.labels[visitors_class]
+
+    def sql_expression(self, visitors_column):
+        """
+        Returns an SQL expression computing the visitor class from a visitor count column.
+        """
+        whens = [(visitors_column >= int(threshold), int(visitors_class))
+                 for threshold, visitors_class in reversed(list(zip(self.thresholds[1:], self.classes[1:])))]
+        if not whens:
+            return int(self.classes[0])
+        return case(whens, else_=int(self.classes[0]))
+
+
+def for_app(app):
+    """
+    Returns the visitor class table compiled from the app's configuration,
+    compiling it on first use.
+    """
+    table = app.extensions.get(_EXTENSION_KEY)
+    if table is None:
+        table = VisitorClassTable(app.config['VISITOR_CLASSES'])
+        app.extensions[_EXTENSION_KEY] = table
+    return table
+
+
+def reclassify_stored_rows(table, dry_run=False):
+    """
+    Recomputes the visitor classes of the stored actual visitor counts with a
+    single UPDATE, e.g. after VISITOR_CLASSES has changed. Predicted classes
+    come from the classifier, not from the thresholds, so they are not touched.
+    Must be called within an app context.
+    :param table: the VisitorClassTable to classify with
+    :param dry_run: only count the rows whose class would change
+    :return: the number of rows whose class changed (or would change)
+    """
+    actual = models.ZooStatisticActual
+    new_class = table.sql_expression(actual.visitors)
+    changed = models.db.session.query(actual).filter(actual.visitors_class != new_class)
+
+    if dry_run:
+        return changed.count()
+
+    count = changed.update({actual.visitors_class: new_class}, synchronize_session=False)
+    if count:
+        models.bump_data_version()
+    models.db.session.commit()
+    logger.info("Reclassified {n} stored visitor counts".format(n=count))
+    return count
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='only report how many stored rows would get a different class')
+    return parser
+
+
+def main():
+    logging.config.dictConfig(config.LOGGING_CONF)
+
+    args = _get_arg_parser().parse_args()
+    app = appfactory.create_app(__name__)
+
+    with app.app_context():
+        count = reclassify_stored_rows(for_app(app), dry_run=args.dry_run)
+
+    if args.dry_run:
+        print("{n} stored visitor counts would be reclassified".format(n=count))
+    else:
+        print("Reclassified {n} stored visitor counts".format(n=count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# WSGI entry point for serving ZooPredict in production
+# Project in Practical Machine Learning, University of Helsinki, 2017
+#
+# Used by gunicorn (see gunicorn.conf.py and the Procfile). With app preloading
+# this module is imported once in the gunicorn master process, so the
+# prediction models are unpickled there and shared copy-on-write with the
+# forked worker processes.
+
+import logging
+import logging.config
+
+import config
+import models
+import predictor
+from zoopredict_web import app
+
+logging.config.dictConfig(config.LOGGING_CONF)
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    """
+    Loads the prediction models before the workers are forked and closes the
+    database connections used for it, so that no connection is shared
+    between processes.
+    """
+    with app.app_context():
+        try:
+            predictor.model_registry.load()
+        except LookupError:
+            logger.warning("No trained models in the database; they will be loaded once available")
+        models.db.get_engine(app).dispose()
+
+
+preload()
@@ -4,13 +4,19 @@
 #
 # This is run periodically once a day from command line.
 
+import argparse
+import itertools
 import openpyxl.reader.excel
 import urllib.request
 import os
 import datetime
+import appfactory
+import checkpoints
 import models
+import metrics
+import profiling
+import visitor_classes
 import config
-from flask import Flask
 import logging
 import logging.config
 from datetime import date
@@ -22,7 +28,8 @@ logger = logging.getLogger(__name__)
 def zoodatafetcher(app, history=False):
     logger.info("Running zoo data harvester")
     # Names that match the sheet names in the source Excel workbook for month collection
-    month_dict = ["Tammikuu", "Helmikuu", "Maaliskuu", "Huhtikuu", "Toukokuu"]
+    month_dict = ["Tammikuu", "Helmikuu", "Maaliskuu", "Huhtikuu", "Toukokuu", "Kesäkuu",
+                  "Heinäkuu", "Elokuu", "Syyskuu", "Lokakuu", "Marraskuu", "Joulukuu"]
 
     datafile = 'Ktkuluva.xlsx'
     if os._exists(datafile):
@@ -34,50 +41,80 @@ def zoodatafetcher(app, history=False):
 
     if history is False:
         # The default option
-        # Assumed the script will always check yesterday's statistics as current day statistics are unavailable
-        date = datetime.date.today() - datetime.timedelta(days=1)
-        sheet = workbook[month_dict[date.month - 1]]
-        _save_to_db(app, _read_daylist_from_month_statistic(sheet, [date]))
+        # Current day statistics are unavailable, so check yesterday's statistics and those of
+        # any earlier days in the backfill window that are still missing.
+        today = datetime.date.today()
+        start, end = checkpoints.backfill_window(today, app.config['HARVEST_BACKFILL_DAYS'])
+        with app.app_context():
+            missing = checkpoints.missing_dates(checkpoints.ZOO_STATISTIC, start, end, models.ZooStatisticActual)
+
+        # The workbook only covers the current year, so e.g. on January 1st
+        # yesterday's statistics cannot be read from it
+        workbook_year = today.year
+        class_table = visitor_classes.for_app(app)
+        statistics = []
+        for (year, month), dates in itertools.groupby(missing, key=lambda d: (d.year, d.month)):
+            dates = list(dates)
+            if year != workbook_year:
+                logger.warning("The zoo statistics workbook covers {w}; skipping {n} missing dates of {y}".format(
+                    w=workbook_year, n=len(dates), y=year))
+                continue
+            sheet_name = month_dict[month - 1]
+            if sheet_name not in workbook.sheetnames:
+                logger.warning("No sheet {s} in the zoo statistics workbook yet".format(s=sheet_name))
+                continue
+            statistics.extend(_read_daylist_from_month_statistic(workbook[sheet_name], dates, class_table))
+        _save_to_db(app, statistics)
+        logger.info("Stored visitor counts for {n} of {m} missing dates".format(n=len(statistics), m=len(missing)))
 
     else:
         # get history data too. To be written later
         pass
 
 
-def _read_daylist_from_month_statistic(worksheet, dates):
+def _read_daylist_from_month_statistic(worksheet, dates, class_table):
     values = list(worksheet.iter_rows())[5:36]
     result = []
     for day in dates:
         value = values[day.day-1][3].value
-        # Assumption is that values are continuous until the day count is empty for future days
+        # The count of a day may be filled in late, so an empty cell only skips that day;
+        # it stays missing and is tried again on the next run
         if value is None:
-            break
-        result.append(models.ZooStatisticActual(day, value, _visitor_class_resolver(value)))
+            continue
+        result.append(models.ZooStatisticActual(day, value, class_table.classify(value)))
     return result
 
 
 def _save_to_db(app, list):
-    models.db.init_app(app)
     with app.app_context():
         for object in list:
             models.db.session.add(object)
-        models.db.session.commit()
+        checkpoints.mark_harvested(checkpoints.ZOO_STATISTIC, [object.date for object in list])
+        if list:
+            models.bump_data_version()
+        with metrics.histogram("db_commit_seconds", "Duration of database commits").time(job='zoodatafetcher'):
+            models.db.session.commit()
+    metrics.counter("harvested_rows_total", "Rows stored by the harvesters").inc(len(list), job='zoodatafetcher')
 
 
-def _visitor_class_resolver(count):
-    visitor_class = 99
-    for item,value in config.VISITOR_CLASSES.items():
-        if count > value['min']:
-            visitor_class = item
-    return visitor_class
+def _get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        default=profiling.is_enabled_by_environment(),
+                        help='profile the harvester run and write a report into PROFILE_OUTPUT_DIR')
+    return parser
 
 
 def main():
     logging.config.dictConfig(config.LOGGING_CONF)
 
-    app = Flask(__name__)
-    app.config.from_object("config")
-    zoodatafetcher(app)
+    args = _get_arg_parser().parse_args()
+
+    app = appfactory.create_app(__name__)
+    with profiling.profiled('zoodatafetcher', app.config['PROFILE_OUTPUT_DIR'], enabled=args.profile):
+        zoodatafetcher(app)
+
+    metrics.dump_json_if_configured(app.config)
 
 if __name__ == "__main__":
     main()
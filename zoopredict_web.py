@@ -2,31 +2,120 @@
 # Provides the web UI for viewing predictions, actual realized values
 # and prediction accuracy.
 
+import datetime
 import logging
 import logging.config
+import math
 import os
+import time
 
-from flask import Flask, render_template
-from flask_babel import Babel
+from flask import Markup, Response, abort, g, jsonify, render_template, request
+from flask_babel import Babel, get_locale
 from sklearn.metrics import mean_absolute_error, mean_squared_error, median_absolute_error, accuracy_score
 
+import appfactory
+import cache
+import metrics
 import models
+import predictor
+import profiling
+import visitor_classes
 import config
 
 
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config.from_object("config")
+# Initialize Flask app and the SQLAlchemy db with it
+app = appfactory.create_app(__name__)
 babel = Babel(app)
 
-# Initialize the SQLAlchemy db with the app to set configuration
-models.db.init_app(app)
+# rendered fragments of the index page by (fragment, locale, data version)
+_INDEX_FRAGMENTS = ('performance_measurements', 'predictions_table')
+_fragment_cache = cache.TTLCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'],
+                                 metric_prefix='fragment_cache')
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start_time = time.time()
+
+
+@app.before_request
+def _start_request_profiler():
+    # only requests that explicitly ask for profiling pay for it
+    if not app.config['PROFILE_WEB_REQUESTS']:
+        return
+    if profiling.is_true(request.args.get('profile')) or \
+            profiling.is_true(request.headers.get('X-ZooPredict-Profile')):
+        profiler = profiling.Profiler("web-" + (request.endpoint or 'unknown'), app.config['PROFILE_OUTPUT_DIR'])
+        profiler.start()
+        g.profiler = profiler
+
+
+@app.teardown_request
+def _stop_request_profiler(exception=None):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        profiler.write_report()
+
+
+@app.after_request
+def _record_request_latency(response):
+    start_time = getattr(g, 'request_start_time', None)
+    if start_time is not None:
+        endpoint = request.endpoint or 'unknown'
+        metrics.histogram("http_request_seconds", "Latency of HTTP requests to the web app")\
+               .observe(time.time() - start_time, endpoint=endpoint)
+        metrics.counter("http_requests_total", "HTTP requests to the web app")\
+               .inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.before_request
+def _refresh_prediction_models():
+    # The production server preloads the models (see wsgi.py); here they are
+    # only reloaded when training has stored new ones.
+    try:
+        predictor.model_registry.refresh_if_stale(app.config['MODEL_REFRESH_INTERVAL'])
+    except LookupError:
+        logger.debug("No trained models available")
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Exposes the collected metrics of this process in the Prometheus text format.
+    """
+    return Response(metrics.registry.render_prometheus(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route("/")
 def index():
+    # the fragments only change when the data does, so they are rendered once
+    # per locale and data version; on a cache hit the predictions are not queried
+    with app.app_context():
+        data_version = models.get_data_version()
+    locale = str(get_locale())
+    keys = [(fragment, locale, data_version) for fragment in _INDEX_FRAGMENTS]
+    fragments = [_fragment_cache.get(key) for key in keys]
+
+    if any(fragment is None for fragment in fragments):
+        fragments = _render_index_fragments()
+        for key, fragment in zip(keys, fragments):
+            _fragment_cache.put(key, fragment)
+
+    return render_template("index.html",
+                           performance_measurements=Markup(fragments[0]),
+                           predictions_table=Markup(fragments[1]),
+                           model_registry=predictor.model_registry)
+
+
+def _render_index_fragments():
+    """
+    Renders the fragments of the index page that depend on the stored predictions and actual values.
+    :return: list of rendered fragments in the order of _INDEX_FRAGMENTS
+    """
     with app.app_context():
         results = models.get_zoo_predictions_and_actuals()
 
@@ -46,12 +135,49 @@ def index():
     median_absolute = median_absolute_error(regression_actuals_tmp, regression_preds_tmp)
     accuracy = accuracy_score(classification_actuals_tmp, classification_preds_tmp)
 
-    return render_template("index.html",
-                           predictions=predictions[:20],
-                           mean_squared_error=mean_squared,
-                           mean_absolute_error=mean_absolute,
-                           median_absolute_error=median_absolute,
-                           accuracy=accuracy)
+    return [render_template("_performance_measurements.html",
+                            mean_squared_error=mean_squared,
+                            mean_absolute_error=mean_absolute,
+                            median_absolute_error=median_absolute,
+                            accuracy=accuracy),
+            render_template("_predictions_table.html",
+                            predictions=predictions[:20],
+                            members=models.get_prediction_members([p['prediction'].id for p in predictions[:20]]))]
+
+
+@app.route("/api/predict")
+def predict():
+    """
+    Predicts visitors for a single day from the given weather, e.g.
+    /api/predict?date=2017-03-01&temp_max=2.5&precipitation=0.3
+    """
+    try:
+        date = datetime.datetime.strptime(request.args['date'], "%Y-%m-%d").date()
+        temp_max = float(request.args['temp_max'])
+        precipitation = float(request.args.get('precipitation', 0.0))
+    except (KeyError, ValueError):
+        abort(400)
+    # float() accepts 'nan' and 'inf', which the models cannot predict from
+    if not (math.isfinite(temp_max) and math.isfinite(precipitation)):
+        abort(400)
+
+    registry = predictor.model_registry
+    if not registry.loaded:
+        abort(503)
+    classes, visitors, quantiles, members = registry.predict_features_with_members(
+        [temp_max], [precipitation], [date.weekday()])
+
+    visitors_quantiles = None
+    if quantiles[0] is not None:
+        visitors_quantiles = dict(zip(map(str, registry.quantiles), quantiles[0]))
+
+    return jsonify(date=date.isoformat(),
+                   visitors=visitors[0],
+                   visitors_quantiles=visitors_quantiles,
+                   visitors_class=classes[0],
+                   visitors_class_label=visitors_class_to_label(classes[0]),
+                   members=[member._asdict() for member in members[0]],
+                   model_version=list(registry.version))
 
 
 @app.template_filter('visitors_class_to_label')
@@ -61,7 +187,7 @@ def visitors_class_to_label(i):
     :param i:  the numeric class
     :return:   the class label
     """
-    return app.config['VISITOR_CLASSES'][i]['label']
+    return visitor_classes.for_app(app).label(i)
 
 
 if __name__ == "__main__":